@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Optional
+
+from hack_assembler import HackAssembler
+
+PROGRAMS = ["add/Add.asm", "max/Max.asm", "rect/Rect.asm", "pong/Pong.asm"]
+PHASES = ["comments", "spaces", "symbols", "instructions"]
+C_INSTRUCTIONS = [
+    "D=A",
+    "D=M",
+    "M=D",
+    "A=M",
+    "M=M+1",
+    "M=M-1",
+    "A=M-1",
+    "AM=M-1",
+    "D=D+M",
+    "D=M-D",
+    "A=D+A",
+    "D=D-M",
+    "M=D+M",
+    "M=!M",
+    "M=-M",
+    "0;JMP",
+    "D;JNE",
+    "D;JEQ",
+    "D;JGT",
+    "D;JLT",
+]
+REGISTERS = ["SP", "LCL", "ARG", "THIS", "THAT", "R13", "R14", "R15"]
+
+
+def generate(filepath: str, size: int, seed: int = 0):
+    """
+    Write a synthetic program of `size` lines with roughly the mix of the VM
+    translator's output: a label every ~25 instructions, mostly backward or nearby
+    forward jumps, one variable per ~1000 lines (at most 200) and some comments.
+    """
+    rand = random.Random(seed)
+    n_labels = max(1, size // 25)
+    n_variables = max(1, min(200, size // 1000))
+    label = 0
+    with open(filepath, "w") as output_file:
+        for _ in range(size):
+            roll = rand.random()
+            if roll < 0.04 and label < n_labels:
+                line = f"(L{label})"
+                label += 1
+            elif roll < 0.1:
+                line = "// generated comment"
+            elif roll < 0.3:
+                line = f"@{rand.choice(REGISTERS)}"
+            elif roll < 0.42:
+                line = f"@{rand.randrange(32768)}"
+            elif roll < 0.5:
+                line = f"@L{min(n_labels - 1, max(0, label + rand.randrange(-50, 5)))}"
+            elif roll < 0.52:
+                line = f"@var{rand.randrange(n_variables)}"
+            else:
+                line = rand.choice(C_INSTRUCTIONS)
+            output_file.write(f"    {line}\n" if line[0] != "(" else f"{line}\n")
+
+
+def measure_translate(filepath: str, repeat: int) -> dict:
+    with open(filepath, "r") as input_file:
+        lines: list[str] = input_file.read().splitlines()
+    assembler = HackAssembler()
+    best: Optional[dict[str, float]] = None
+    for _ in range(repeat):
+        timings: dict[str, float] = {}
+        assembler.translate(lines, timings)
+        if best is None or sum(timings.values()) < sum(best.values()):
+            best = timings
+    tracemalloc.start()
+    assembler.translate(lines)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total = sum(best.values())
+    return {
+        "lines": len(lines),
+        "lines_per_sec": len(lines) / total,
+        "phases": best,
+        "peak_traced_kb": peak // 1024,
+    }
+
+
+def measure_cli(filepath: str, repeat: int, extra_args: list[str]) -> dict:
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "hack_assembler.py"
+    )
+    best_seconds, peak_rss_kb = None, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, script, filepath, *extra_args])
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        assert status == 0, f"hack_assembler.py failed on {filepath}"
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_kb = max(peak_rss_kb, usage.ru_maxrss)
+    return {"seconds": best_seconds, "peak_rss_kb": peak_rss_kb}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions: list[str] = []
+    for case, result in results.items():
+        expected = baseline.get(case)
+        if expected is None:
+            continue
+        minimum = expected["lines_per_sec"] * (1 - tolerance)
+        # tiny programs are dominated by timer noise
+        if result["lines"] >= 1000 and result["lines_per_sec"] < minimum:
+            regressions.append(
+                f"{case}: {result['lines_per_sec']:.0f} lines/s, "
+                f"baseline {expected['lines_per_sec']:.0f}"
+            )
+        for key in ["peak_traced_kb", "cli_peak_rss_kb"]:
+            if result[key] > expected[key] * (1 + tolerance):
+                regressions.append(
+                    f"{case}: {key} {result[key]}, baseline {expected[key]}"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Hack assembler")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[10**4, 10**5, 10**6],
+        help="line counts of the synthetic programs, e.g. 10000 10000000",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+    parser.add_argument(
+        "--cli-args",
+        nargs=argparse.REMAINDER,
+        default=[],
+        help="extra arguments passed to hack_assembler.py, e.g. --jobs 4",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"
+        ),
+        help="JSON file the results are compared with",
+    )
+    parser.add_argument(
+        "--save",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative slowdown or memory growth before failing",
+    )
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    results: dict[str, dict] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cases: list[tuple[str, str]] = []
+        for program in PROGRAMS:
+            # assemble a copy so that the CLI doesn't write next to the sources
+            filepath = os.path.join(directory, os.path.basename(program))
+            shutil.copyfile(os.path.join(here, program), filepath)
+            cases.append((program, filepath))
+        for size in args.sizes:
+            filepath = os.path.join(directory, f"Synthetic{size}.asm")
+            generate(filepath, size)
+            cases.append((f"synthetic/{size}", filepath))
+        print(
+            f"{'case':<20}{'lines':>10}{'lines/s':>12}"
+            + "".join(f"{phase:>14}" for phase in PHASES)
+            + f"{'traced KB':>12}{'cli s':>9}{'cli RSS KB':>12}"
+        )
+        # run the CLI before anything grows this process: a child's ru_maxrss
+        # starts from the RSS of the process it was forked from
+        cli_results = {
+            case: measure_cli(filepath, args.repeat, args.cli_args)
+            for case, filepath in cases
+        }
+        for case, filepath in cases:
+            result = measure_translate(filepath, args.repeat)
+            cli = cli_results[case]
+            result["cli_seconds"] = cli["seconds"]
+            result["cli_peak_rss_kb"] = cli["peak_rss_kb"]
+            results[case] = result
+            print(
+                f"{case:<20}{result['lines']:>10}{result['lines_per_sec']:>12.0f}"
+                + "".join(f"{result['phases'][phase]:>14.4f}" for phase in PHASES)
+                + f"{result['peak_traced_kb']:>12}{cli['seconds']:>9.3f}"
+                + f"{cli['peak_rss_kb']:>12}"
+            )
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -1,4 +1,18 @@
 import argparse
+import os
+import pickle
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from hack_rom import dump, pack
+from source_map import SourceMap
+
+PUSH_POP = [
+    ["@SP", "M=M+1", "A=M-1", "M=D", "@SP", "M=M-1", "A=M", "D=M"],
+    ["@SP", "M=M+1", "A=M-1", "M=D", "@SP", "AM=M-1", "D=M"],
+]
 
 
 class HackAssembler:
@@ -32,6 +46,13 @@ class HackAssembler:
             "M-D": "1000111",
             "D&M": "1000000",
             "D|M": "1010101",
+            # commutative spellings accepted by the CPU emulator
+            "A+D": "0000010",
+            "A&D": "0000000",
+            "A|D": "0010101",
+            "M+D": "1000010",
+            "M&D": "1000000",
+            "M|D": "1010101",
         }
         self.__jump_code = ["", "JGT", "JEQ", "JGE", "JLT", "JNE", "JLE", "JMP"]
         self.__defined_symbols = {
@@ -59,22 +80,466 @@ class HackAssembler:
             "SCREEN": 0x4000,
             "KBD": 0x6000,
         }
+        self.__state_version = 2
+        self.__dest_code = ["", "M", "D", "MD", "A", "AM", "AD", "AMD"]
+        # C-instruction text -> 16-bit word, prepopulated with every legal spelling
+        self.__c_instruction_cache: dict[str, int] = {}
+        for dest in self.__dest_code:
+            for comp in self.__comp_code:
+                for jump in self.__jump_code:
+                    line = f"{dest}={comp}" if dest else comp
+                    self.__encode_c_instruction(f"{line};{jump}" if jump else line)
+        # number of instructions removed by the last optimized translation
+        self.removed_instructions = 0
+
+    def translate(
+        self,
+        lines: list[str],
+        timings: Optional[dict[str, float]] = None,
+        optimize: bool = False,
+    ) -> list[str]:
+        """
+        :param timings: if given, seconds spent in each phase are added to it
+        :param optimize: run the peephole optimizer before resolving symbols
+        """
+        if timings is None:
+            lines = self.__handle_spaces(self.__handle_comments(lines))
+            if optimize:
+                lines = self.__optimize(lines)
+            return self.__handle_instructions(self.__handle_symbols(lines))
+        phases = [
+            ("comments", self.__handle_comments),
+            ("spaces", self.__handle_spaces),
+            ("symbols", self.__handle_symbols),
+            ("instructions", self.__handle_instructions),
+        ]
+        if optimize:
+            phases.insert(2, ("optimize", self.__optimize))
+        for phase, handle in phases:
+            start = time.perf_counter()
+            lines = handle(lines)
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+        return lines
+
+    def assemble(
+        self,
+        lines: list[str],
+        jobs: int,
+        chunk_size: int = 1 << 16,
+        optimize: bool = False,
+        source_map: Optional[SourceMap] = None,
+        source: Optional[str] = None,
+    ) -> array:
+        """
+        Resolve symbols serially, then encode chunks of the resolved program on a
+        pool of `jobs` processes.
+
+        :param source_map: if given, the line of `source` of every ROM address is
+            added to it, through the peephole optimizer
+        :return: the ROM as 16-bit words, identical to the serial translation
+        """
+        numbers = None if source_map is None else self.__source_lines(lines)
+        lines = self.__handle_spaces(self.__handle_comments(lines))
+        if optimize:
+            lines = self.__optimize(lines, numbers)
+        if source_map is not None:
+            self.__map_source(lines, numbers, source_map, source)
+        lines = self.__handle_symbols(lines)
+        if jobs <= 1:
+            return self.encode(lines)
+        chunk_size = max(1, min(chunk_size, -(-len(lines) // jobs)))
+        chunks = [lines[i : i + chunk_size] for i in range(0, len(lines), chunk_size)]
+        rom = array("H")
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for words in executor.map(_encode_chunk, chunks):
+                rom.extend(words)
+        return rom
+
+    def encode(self, lines: list[str]) -> array:
+        """
+        Encode instructions whose symbols have already been resolved.
+        """
+        words = array("H")
+        for line in lines:
+            if self.__is_a_instruction(line):
+                words.append(int(line[1:]) & 0x7FFF)
+            else:
+                words.append(self.__encode_c_instruction(line))
+        return words
+
+    def stream(
+        self,
+        lines: Iterable[str],
+        source_map: Optional[SourceMap] = None,
+        source: Optional[str] = None,
+    ) -> Iterator[tuple[int, Optional[int]]]:
+        """
+        Single-pass assembly of a line iterator.
+
+        :param source_map: if given, the line of `source` of every ROM address is
+            added to it
+        :return: (ROM address, 16-bit word) pairs in address order. A-instructions
+            referencing a symbol that is not known yet are yielded as (address, None)
+            and yielded again with their word once the input is exhausted.
+        """
+        symbols = self.__defined_symbols.copy()
+        # symbol -> ROM addresses waiting for it, in order of first reference
+        unresolved: dict[str, array] = {}
+        address = 0
+        for number, line in enumerate(lines, 1):
+            line = "".join(line.split("//")[0].split())
+            if not line:
+                continue
+            if line[0] == "(" and line[-1] == ")":
+                symbols[line[1:-1]] = address
+                continue
+            if source_map is not None:
+                source_map.add(address, source, number)
+            if self.__is_a_instruction(line):
+                value: str = line[1:]
+                if value.isdigit():
+                    yield address, int(value) & 0x7FFF
+                elif value in symbols:
+                    yield address, symbols[value] & 0x7FFF
+                else:
+                    unresolved.setdefault(value, array("L")).append(address)
+                    yield address, None
+            else:
+                yield address, self.__encode_c_instruction(line)
+            address += 1
+        counter = 16
+        for value, addresses in unresolved.items():
+            if value not in symbols:
+                symbols[value] = counter
+                counter += 1
+            word = symbols[value] & 0x7FFF
+            for address in addresses:
+                yield address, word
 
-    def translate(self, lines: list[str]) -> list[str]:
-        return self.__handle_instructions(
-            self.__handle_symbols(self.__handle_spaces(self.__handle_comments(lines)))
+    def reassemble(
+        self,
+        lines: list[str],
+        state: Optional[dict] = None,
+        source_map: Optional[SourceMap] = None,
+        source: Optional[str] = None,
+    ) -> tuple[array, dict]:
+        """
+        Incremental assembly against the state returned by the previous call. Only
+        the lines between the first and the last difference are re-encoded, unless
+        label addresses or the variables in order of first reference change, which
+        falls back to a full build, so the ROM is always that of `translate()`.
+
+        :param source_map: if given, the line of `source` of every ROM address is
+            added to it
+        :return: the ROM as 16-bit words and the state for the next call
+        """
+        numbers = None if source_map is None else self.__source_lines(lines)
+        lines = self.__handle_spaces(self.__handle_comments(lines))
+        if source_map is not None:
+            self.__map_source(lines, numbers, source_map, source)
+        if state is None or state.get("version") != self.__state_version:
+            return self.__build_state(lines)
+        old_lines: list[str] = state["lines"]
+        prefix, limit = 0, min(len(lines), len(old_lines))
+        while prefix < limit and lines[prefix] == old_lines[prefix]:
+            prefix += 1
+        suffix, limit = 0, limit - prefix
+        while suffix < limit and lines[-1 - suffix] == old_lines[-1 - suffix]:
+            suffix += 1
+        old_labels: dict[str, int] = {}
+        old_middle = self.__collect_labels(
+            old_lines[prefix : len(old_lines) - suffix], old_labels
+        )
+        labels: dict[str, int] = {}
+        middle = self.__collect_labels(lines[prefix : len(lines) - suffix], labels)
+        shift = len(middle) - len(old_middle)
+        if labels != old_labels or (
+            shift != 0 and state["last_label"] >= len(old_lines) - suffix
+        ):
+            return self.__build_state(lines)
+        # variables are allocated in order of first reference in the whole program
+        symbols: dict[str, int] = state["symbols"]
+        variables: list[str] = state["variables"]
+        defined = symbols.keys() - set(variables)
+        if self.__variables(lines, defined) != variables:
+            return self.__build_state(lines)
+
+        start = sum(line[0] != "(" for line in lines[:prefix])
+        words: array = state["words"]
+        self.__resolve_variables(middle, symbols, 16 + len(variables))
+        words[start : start + len(old_middle)] = self.encode(middle)
+        state["lines"] = lines
+        return words, state
+
+    def __build_state(self, lines: list[str]) -> tuple[array, dict]:
+        symbols = self.__defined_symbols.copy()
+        results = self.__collect_labels(lines, symbols)
+        variables = self.__variables(results, symbols.keys())
+        self.__resolve_variables(results, symbols, 16)
+        last_label = max(
+            (idx for (idx, line) in enumerate(lines) if line[0] == "("), default=-1
+        )
+        words = self.encode(results)
+        return words, {
+            "version": self.__state_version,
+            "lines": lines,
+            "symbols": symbols,
+            "variables": variables,
+            "last_label": last_label,
+            "words": words,
+        }
+
+    def __optimize(
+        self, lines: list[str], numbers: Optional[list[int]] = None
+    ) -> list[str]:
+        """
+        Peephole passes over cleaned assembly, repeated until none applies. Labels
+        are basic-block boundaries: nothing is assumed about the registers after
+        one. Removed instructions shift the addresses of everything after them,
+        so programs jumping to numeric addresses are left unchanged.
+
+        :param numbers: if given, the source line of each line, replaced in place
+            by those of the lines that are kept
+        """
+        self.removed_instructions = 0
+        for idx in range(len(lines) - 1):
+            if (
+                lines[idx][1:].isdigit()
+                and self.__is_a_instruction(lines[idx])
+                and not self.__is_a_instruction(lines[idx + 1])
+                and ";" in lines[idx + 1]
+            ):
+                return lines
+        size = sum(1 for line in lines if not self.__is_label(line))
+        kept = list(range(len(lines))) if numbers is None else numbers
+        while True:
+            optimized, kept = self.__eliminate_dead_code(
+                *self.__thread_jumps(
+                    *self.__cancel_push_pop(
+                        *self.__eliminate_redundant_loads(lines, kept)
+                    )
+                )
+            )
+            if optimized == lines:
+                break
+            lines = optimized
+        if numbers is not None:
+            numbers[:] = kept
+        self.removed_instructions = size - sum(
+            1 for line in lines if not self.__is_label(line)
         )
+        return lines
+
+    def __eliminate_redundant_loads(
+        self, lines: list[str], numbers: list[int]
+    ) -> tuple[list[str], list[int]]:
+        """
+        Drop `@X` when A already holds X, an A-instruction overwritten by the next
+        one, and `D=M` right after `M=D` when A is known not to be the keyboard,
+        whose writes are ignored.
+        """
+        results: list[str] = []
+        kept: list[int] = []
+        address: Optional[str] = None
+        for line, number in zip(lines, numbers):
+            if self.__is_label(line):
+                address = None
+            elif self.__is_a_instruction(line):
+                if line == address:
+                    continue
+                if results and self.__is_a_instruction(results[-1]):
+                    results.pop()
+                    kept.pop()
+                address = line
+            elif (
+                line == "D=M"
+                and results
+                and results[-1] == "M=D"
+                and address is not None
+                and not self.__is_memory_mapped(address)
+            ):
+                continue
+            elif "A" in self.__split_c_instruction(line)[0]:
+                address = None
+            results.append(line)
+            kept.append(number)
+        return results, kept
+
+    def __cancel_push_pop(
+        self, lines: list[str], numbers: list[int]
+    ) -> tuple[list[str], list[int]]:
+        """
+        A push of D immediately popped back into D leaves D and SP unchanged, so
+        the pair is dropped when the next instruction loads A anyway.
+        """
+        results: list[str] = []
+        kept: list[int] = []
+        idx = 0
+        while idx < len(lines):
+            for pattern in PUSH_POP:
+                end = idx + len(pattern)
+                if (
+                    end < len(lines)
+                    and self.__is_a_instruction(lines[end])
+                    and lines[idx:end] == pattern
+                ):
+                    idx = end
+                    break
+            else:
+                results.append(lines[idx])
+                kept.append(numbers[idx])
+                idx += 1
+        return results, kept
+
+    def __thread_jumps(
+        self, lines: list[str], numbers: list[int]
+    ) -> tuple[list[str], list[int]]:
+        """
+        Retarget jumps to a label whose block only jumps elsewhere, unless the
+        jump is conditional and A is used after it, and drop jumps to the label
+        that follows them when the next instruction loads A anyway.
+        """
+        trampolines: dict[str, str] = {}
+        for idx, line in enumerate(lines):
+            if not self.__is_label(line):
+                continue
+            end = idx + 1
+            while end < len(lines) and self.__is_label(lines[end]):
+                end += 1
+            following = lines[end : end + 2]
+            if (
+                len(following) == 2
+                and self.__is_a_instruction(following[0])
+                and self.__is_jump(following[1])
+                and self.__is_unconditional_jump(following[1])
+            ):
+                trampolines[line[1:-1]] = following[0][1:]
+
+        results: list[str] = []
+        kept: list[int] = []
+        idx = 0
+        while idx < len(lines):
+            line = lines[idx]
+            if (
+                self.__is_a_instruction(line)
+                and idx + 1 < len(lines)
+                and self.__is_jump(lines[idx + 1])
+            ):
+                target = line[1:]
+                visited = {target}
+                while target in trampolines and trampolines[target] not in visited:
+                    target = trampolines[target]
+                    visited.add(target)
+                end = idx + 2
+                while end < len(lines) and self.__is_label(lines[end]):
+                    end += 1
+                if (
+                    f"({target})" in lines[idx + 2 : end]
+                    and end < len(lines)
+                    and self.__is_a_instruction(lines[end])
+                ):
+                    idx += 2
+                    continue
+                # a conditional jump falls through with A still holding the
+                # target, which the next instructions may use as an address
+                if not self.__is_unconditional_jump(lines[idx + 1]) and not (
+                    idx + 2 == len(lines)
+                    or self.__is_a_instruction(lines[idx + 2])
+                    or self.__is_label(lines[idx + 2])
+                ):
+                    target = line[1:]
+                results.append(f"@{target}")
+                results.append(lines[idx + 1])
+                kept.extend(numbers[idx : idx + 2])
+                idx += 2
+                continue
+            results.append(line)
+            kept.append(numbers[idx])
+            idx += 1
+        return results, kept
+
+    def __eliminate_dead_code(
+        self, lines: list[str], numbers: list[int]
+    ) -> tuple[list[str], list[int]]:
+        """
+        Drop instructions between an unconditional jump and the next label.
+        """
+        results: list[str] = []
+        kept: list[int] = []
+        reachable = True
+        for line, number in zip(lines, numbers):
+            if self.__is_label(line):
+                reachable = True
+            elif not reachable:
+                continue
+            elif not self.__is_a_instruction(line) and self.__is_unconditional_jump(
+                line
+            ):
+                reachable = False
+            results.append(line)
+            kept.append(number)
+        return results, kept
+
+    def __is_label(self, line: str) -> bool:
+        return line[0] == "(" and line[-1] == ")"
+
+    def __split_c_instruction(self, line: str) -> tuple[str, str, str]:
+        dest, _, comp = line.rpartition("=")
+        comp, _, jump = comp.partition(";")
+        return dest, comp, jump
+
+    def __is_jump(self, line: str) -> bool:
+        # a jump without dest, whose comp has no side effect to keep and doesn't
+        # read A or M, which changing its @X would change
+        return (
+            not self.__is_a_instruction(line)
+            and ";" in line
+            and "=" not in line
+            and not {"A", "M"} & set(self.__split_c_instruction(line)[1])
+        )
+
+    def __is_memory_mapped(self, address: str) -> bool:
+        # reading the keyboard doesn't give what was written to it
+        symbol = address[1:]
+        if symbol.isdigit():
+            return int(symbol) >= self.__defined_symbols["KBD"]
+        return symbol == "KBD"
+
+    def __is_unconditional_jump(self, line: str) -> bool:
+        return self.__split_c_instruction(line)[2] == "JMP"
 
     def __handle_symbols(self, lines: list[str]) -> list[str]:
         symbols = self.__defined_symbols.copy()
+        results = self.__collect_labels(lines, symbols)
+        self.__resolve_variables(results, symbols, 16)
+        return results
+
+    def __collect_labels(self, lines: list[str], symbols: dict[str, int]) -> list[str]:
         results: list[str] = []
         for line in lines:
             if line[0] == "(" and line[-1] == ")":
                 symbols[line[1:-1]] = len(results)
             else:
                 results.append(line)
-        counter = 16
-        for (idx, line) in enumerate(results):
+        return results
+
+    def __variables(self, lines: list[str], defined: Iterable[str]) -> list[str]:
+        """
+        :return: the symbols that aren't in `defined`, in order of first reference
+        """
+        defined = set(defined)
+        variables: dict[str, None] = {}
+        for line in lines:
+            if self.__is_a_instruction(line):
+                value: str = line[1:]
+                if not value.isdigit() and value not in defined:
+                    variables[value] = None
+        return list(variables)
+
+    def __resolve_variables(
+        self, lines: list[str], symbols: dict[str, int], counter: int
+    ) -> int:
+        for (idx, line) in enumerate(lines):
             if self.__is_a_instruction(line):
                 value: str = line[1:]
                 if value.isdigit():
@@ -82,8 +547,8 @@ class HackAssembler:
                 if value not in symbols:
                     symbols[value] = counter
                     counter += 1
-                results[idx] = line[0] + str(symbols[value])
-        return results
+                lines[idx] = line[0] + str(symbols[value])
+        return counter
 
     def __translate_dest(self, line: str) -> str:
         result = 0
@@ -124,15 +589,45 @@ class HackAssembler:
             + self.__translate_jump(line)
         )
 
+    def __encode_c_instruction(self, line: str) -> int:
+        word = self.__c_instruction_cache.get(line)
+        if word is None:
+            word = int(self.__translate_c_instruction(line), 2)
+            self.__c_instruction_cache[line] = word
+        return word
+
     def __handle_instructions(self, lines: list[str]) -> list[str]:
         result: list[str] = []
         for line in lines:
             if self.__is_a_instruction(line):
                 result.append(self.__translate_a_instruction(line))
             else:
-                result.append(self.__translate_c_instruction(line))
+                result.append(format(self.__encode_c_instruction(line), "016b"))
         return result
 
+    def __source_lines(self, lines: list[str]) -> list[int]:
+        """
+        :return: the line number of each line that __handle_spaces keeps
+        """
+        return [
+            number
+            for number, line in enumerate(lines, 1)
+            if line.split("//")[0].strip()
+        ]
+
+    def __map_source(
+        self,
+        lines: list[str],
+        numbers: list[int],
+        source_map: SourceMap,
+        source: Optional[str],
+    ):
+        address = 0
+        for line, number in zip(lines, numbers):
+            if not self.__is_label(line):
+                source_map.add(address, source, number)
+                address += 1
+
     def __handle_spaces(self, lines: list[str]) -> list[str]:
         return ["".join(line.split()) for line in lines if line.strip()]
 
@@ -140,19 +635,92 @@ class HackAssembler:
         return [line.split("//")[0] for line in lines]
 
 
+_worker_assembler: Optional[HackAssembler] = None
+
+
+def _encode_chunk(lines: list[str]) -> array:
+    global _worker_assembler
+    if _worker_assembler is None:
+        _worker_assembler = HackAssembler()
+    return _worker_assembler.encode(lines)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Translate Hack assembly code to Hack binary code"
     )
     parser.add_argument("asm", help="filepath of Hack assembly code")
+    parser.add_argument(
+        "--format",
+        choices=["text", "packed"],
+        default="text",
+        help="write a .hack text file or a packed little-endian .hackb ROM image",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="reuse the state persisted next to the output by the previous run",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="encode on a pool of N processes instead of streaming the input",
+    )
+    parser.add_argument(
+        "--optimize",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="remove redundant instructions before resolving symbols",
+    )
+    parser.add_argument(
+        "--source-map",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="also write the line of the .asm file of every address to a .map file",
+    )
     args = parser.parse_args()
+    if args.optimize and args.incremental:
+        parser.error("--optimize can't be combined with --incremental")
 
     filepath: str = args.asm
     assert filepath.endswith(".asm"), f"{filepath} doesn't end with .asm"
 
-    output: str = filepath.rstrip(".asm") + ".hack"
+    output: str = filepath.rstrip(".asm") + (
+        ".hackb" if args.format == "packed" else ".hack"
+    )
     assembler: HackAssembler = HackAssembler()
-    with open(filepath, "r") as input_file:
-        code: list[str] = input_file.read().splitlines()
-        with open(output, "w") as output_file:
-            output_file.write("\n".join(assembler.translate(code)))
+    source_map = SourceMap(step=True) if args.source_map else None
+    with open(filepath, "r") as input_file, open(output, "wb") as output_file:
+        if args.incremental:
+            code: list[str] = input_file.read().splitlines()
+            state_path: str = output + ".state"
+            state: Optional[dict] = None
+            if os.path.exists(state_path):
+                with open(state_path, "rb") as state_file:
+                    state = pickle.load(state_file)
+            rom, state = assembler.reassemble(code, state, source_map, filepath)
+            dump(rom, output_file, args.format)
+            with open(state_path, "wb") as state_file:
+                pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+        elif args.jobs > 1 or args.optimize:
+            code: list[str] = input_file.read().splitlines()
+            rom = assembler.assemble(
+                code,
+                args.jobs,
+                optimize=args.optimize,
+                source_map=source_map,
+                source=filepath,
+            )
+            dump(rom, output_file, args.format)
+            if args.optimize:
+                print(
+                    f"Removed {assembler.removed_instructions} of "
+                    f"{len(rom) + assembler.removed_instructions} instructions"
+                )
+        else:
+            rom = pack(assembler.stream(input_file, source_map, filepath))
+            dump(rom, output_file, args.format)
+    if source_map is not None:
+        source_map.write(output + ".map")
@@ -0,0 +1,382 @@
+import argparse
+import time
+from array import array
+from typing import Callable, Optional, Sequence
+
+import hack_rom
+from hack_assembler import HackAssembler
+
+ROM_SIZE = 0x8000
+RAM_SIZE = 0x8000
+SCREEN = 0x4000
+KBD = 0x6000
+
+# predecoded instruction kinds
+A_INSTRUCTION = 0
+C_INSTRUCTION = 1
+C_JUMP = 2
+HALT = 3
+# one past the end of the ROM, where the 15-bit PC wraps around to 0
+WRAP = 4
+
+
+def alu(control: int, x: int, y: int) -> int:
+    """
+    The ALU of projects/02 on 16-bit unsigned values, x being D and y being A or M.
+    :param control: the six bits zx, nx, zy, ny, f, no
+    """
+    if control & 0b100000:
+        x = 0
+    if control & 0b010000:
+        x = ~x & 0xFFFF
+    if control & 0b001000:
+        y = 0
+    if control & 0b000100:
+        y = ~y & 0xFFFF
+    out = (x + y) & 0xFFFF if control & 0b000010 else x & y
+    if control & 0b000001:
+        out = ~out & 0xFFFF
+    return out
+
+
+# the computations of the Hack language, by their six control bits
+COMPUTATIONS: dict[int, Callable[[int, int], int]] = {
+    0b101010: lambda d, y: 0,
+    0b111111: lambda d, y: 1,
+    0b111010: lambda d, y: 0xFFFF,
+    0b001100: lambda d, y: d,
+    0b110000: lambda d, y: y,
+    0b001101: lambda d, y: d ^ 0xFFFF,
+    0b110001: lambda d, y: y ^ 0xFFFF,
+    0b001111: lambda d, y: -d & 0xFFFF,
+    0b110011: lambda d, y: -y & 0xFFFF,
+    0b011111: lambda d, y: (d + 1) & 0xFFFF,
+    0b110111: lambda d, y: (y + 1) & 0xFFFF,
+    0b001110: lambda d, y: (d - 1) & 0xFFFF,
+    0b110010: lambda d, y: (y - 1) & 0xFFFF,
+    0b000010: lambda d, y: (d + y) & 0xFFFF,
+    0b010011: lambda d, y: (d - y) & 0xFFFF,
+    0b000111: lambda d, y: (y - d) & 0xFFFF,
+    0b000000: lambda d, y: d & y,
+    0b010101: lambda d, y: d | y,
+}
+
+
+def decode(rom: Sequence[int]) -> list[tuple]:
+    """
+    Decode every ROM word once into (kind, operand, reads M, dest bits, jump bits).
+    The operand is the value of an A-instruction or the computation of a
+    C-instruction. `@X, 0;JMP` jumping onto itself is decoded as HALT.
+    """
+    program: list[tuple] = []
+    for address, word in enumerate(rom):
+        if not word & 0x8000:
+            program.append((A_INSTRUCTION, word, False, 0, 0))
+            continue
+        control = (word >> 6) & 0b111111
+        computation = COMPUTATIONS.get(control) or (
+            lambda d, y, control=control: alu(control, d, y)
+        )
+        dest, jump = (word >> 3) & 0b111, word & 0b111
+        if (
+            jump == 0b111
+            and dest == 0
+            and address > 0
+            and rom[address - 1] == address - 1
+        ):
+            program.append((HALT, None, False, 0, 0))
+            continue
+        program.append(
+            (
+                C_JUMP if jump else C_INSTRUCTION,
+                computation,
+                bool(word & 0x1000),
+                dest,
+                jump,
+            )
+        )
+    # the rest of the ROM holds zeros, i.e. @0
+    program.extend([(A_INSTRUCTION, 0, False, 0, 0)] * (ROM_SIZE - len(program)))
+    program.append((WRAP, None, False, 0, 0))
+    return program
+
+
+class HackEmulator:
+    """
+    The Hack computer of projects/05: CPU.hdl with a 32K ROM and Memory.hdl's RAM,
+    SCREEN at 0x4000 and KBD at 0x6000.
+    """
+
+    def __init__(self, rom: Sequence[int]):
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.load(rom)
+
+    def load(self, rom: Sequence[int]):
+        assert len(rom) <= ROM_SIZE, f"{len(rom)} words don't fit in the ROM"
+        self.rom = array("H", rom)
+        self._program = decode(self.rom)
+        self.reset()
+
+    def reset(self):
+        self.pc = self.a = self.d = 0
+        self.cycles = 0
+        self.halted = False
+
+    @property
+    def keyboard(self) -> int:
+        return self.ram[KBD]
+
+    @keyboard.setter
+    def keyboard(self, key: int):
+        self.ram[KBD] = key
+
+    def run(self, max_cycles: int) -> int:
+        """
+        Execute until `max_cycles` instructions have run or the program halts.
+        :return: number of executed instructions
+        """
+        program, ram = self._program, self.ram
+        pc, a, d = self.pc, self.a, self.d
+        cycles = 0
+        # kinds are compared as literals, global lookups are measurably slower here
+        while cycles < max_cycles:
+            kind, operand, reads_m, dest, jump = program[pc]
+            cycles += 1
+            if kind == 0:  # A_INSTRUCTION
+                a = operand
+                pc += 1
+                continue
+            if kind == 1:  # C_INSTRUCTION
+                if reads_m:
+                    out = operand(d, ram[a & 0x7FFF])
+                else:
+                    out = operand(d, a)
+                if dest & 0b001:
+                    ram[a & 0x7FFF] = out
+                if dest & 0b010:
+                    d = out
+                if dest & 0b100:
+                    a = out
+                pc += 1
+                continue
+            if kind == 2:  # C_JUMP
+                address = a & 0x7FFF
+                out = operand(d, ram[address] if reads_m else a)
+                if dest & 0b001:
+                    ram[address] = out
+                if dest & 0b010:
+                    d = out
+                if dest & 0b100:
+                    a = out
+                if jump & (0b100 if out & 0x8000 else (0b010 if out == 0 else 0b001)):
+                    pc = address
+                else:
+                    pc += 1
+                continue
+            cycles -= 1
+            if kind == 3:  # HALT
+                self.halted = True
+                break
+            pc = 0  # WRAP
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += cycles
+        return cycles
+
+
+# Python expressions of the Hack computations, by their six control bits
+EXPRESSIONS: dict[int, str] = {
+    0b101010: "0",
+    0b111111: "1",
+    0b111010: "65535",
+    0b001100: "d",
+    0b110000: "{y}",
+    0b001101: "d ^ 65535",
+    0b110001: "{y} ^ 65535",
+    0b001111: "-d & 65535",
+    0b110011: "-{y} & 65535",
+    0b011111: "(d + 1) & 65535",
+    0b110111: "({y} + 1) & 65535",
+    0b001110: "(d - 1) & 65535",
+    0b110010: "({y} - 1) & 65535",
+    0b000010: "(d + {y}) & 65535",
+    0b010011: "(d - {y}) & 65535",
+    0b000111: "({y} - d) & 65535",
+    0b000000: "d & {y}",
+    0b010101: "d | {y}",
+}
+# conditions on the 16-bit ALU output, by jump bits
+CONDITIONS: dict[int, str] = {
+    0b001: "0 < out < 32768",
+    0b010: "out == 0",
+    0b011: "out < 32768",
+    0b100: "out >= 32768",
+    0b101: "out != 0",
+    0b110: "out == 0 or out >= 32768",
+}
+MAX_BLOCK_SIZE = 256
+
+
+class JitEmulator(HackEmulator):
+    """
+    HackEmulator that compiles the code it enters into Python functions keeping A
+    and D in local variables, with constant A values folded into the code. Each
+    function returns (pc, A, D, instruction count) at its exits, so jumps are
+    resolved there. Functions are cached by start address and dropped when a new
+    ROM is loaded. `run` may overshoot `max_cycles` by the rest of the last trace.
+    """
+
+    def load(self, rom: Sequence[int]):
+        self._blocks: dict[int, Callable] = {}
+        super().load(rom)
+
+    def run(self, max_cycles: int) -> int:
+        blocks, ram = self._blocks, self.ram
+        pc, a, d = self.pc, self.a, self.d
+        cycles = 0
+        while cycles < max_cycles:
+            block = blocks.get(pc)
+            if block is None:
+                if pc == ROM_SIZE:
+                    pc = 0
+                    continue
+                if self._program[pc][0] == HALT:
+                    self.halted = True
+                    break
+                block = blocks[pc] = self.compile(pc)
+            pc, a, d, count = block(ram, a, d)
+            cycles += count
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += cycles
+        return cycles
+
+    def compile(self, start: int) -> Callable:
+        """
+        Compile the trace starting at `start` into a Python function. Conditional
+        jumps leave the function when taken, unconditional jumps to a constant
+        address are followed, so a trace only ends at a computed jump, a HALT, an
+        address it already contains or after MAX_BLOCK_SIZE instructions.
+        """
+        lines = ["def block(ram, a, d):"]
+        # value of A when it is a known constant not yet stored in the local `a`
+        known_a: Optional[int] = None
+        pc, count, visited = start, 0, set()
+        while count < MAX_BLOCK_SIZE:
+            if pc >= ROM_SIZE or pc in visited or self._program[pc][0] == HALT:
+                break
+            visited.add(pc)
+            word = self.rom[pc] if pc < len(self.rom) else 0
+            pc += 1
+            count += 1
+            if not word & 0x8000:
+                known_a = word
+                continue
+            control, dest, jump = (word >> 6) & 0b111111, (word >> 3) & 0b111, word & 7
+            address = "a & 32767" if known_a is None else str(known_a)
+            value = "a" if known_a is None else str(known_a)
+            y = f"ram[{address}]" if word & 0x1000 else value
+            expression = EXPRESSIONS.get(control)
+            expression = (
+                f"alu({control}, d, {y})"
+                if expression is None
+                else expression.format(y=y)
+            )
+            target = address
+            if jump and known_a is None and dest & 0b100:
+                # jumps go to A as it was before this instruction
+                lines.append(f"    target = {address}")
+                target = "target"
+            destinations = [
+                destination
+                for (bit, destination) in [
+                    (0b001, f"ram[{address}]"),
+                    (0b010, "d"),
+                    (0b100, "a"),
+                ]
+                if dest & bit
+            ]
+            if (jump and jump != 0b111) or len(destinations) > 1:
+                lines.append(f"    out = {expression}")
+                expression = "out"
+            lines.extend(f"    {name} = {expression}" for name in destinations)
+            if dest & 0b100:
+                known_a = None
+            if not jump:
+                continue
+            state = f"{'a' if known_a is None else known_a}, d, {count}"
+            if jump != 0b111:
+                lines.append(f"    if {CONDITIONS[jump]}:")
+                lines.append(f"        return {target}, {state}")
+            elif target.isdigit():
+                pc = int(target)
+            else:
+                lines.append(f"    return {target}, {state}")
+                break
+        if not lines[-1].startswith("    return"):
+            state = f"{'a' if known_a is None else known_a}, d, {count}"
+            lines.append(f"    return {pc}, {state}")
+        namespace = {"alu": alu}
+        exec(compile("\n".join(lines), f"<hack block {start}>", "exec"), namespace)
+        return namespace["block"]
+
+
+def load_program(filepath: str) -> Sequence[int]:
+    """
+    Load a .hack text file, a packed .hackb image or an .asm file.
+    """
+    if filepath.endswith(".asm"):
+        rom = array("H", bytes(2 * ROM_SIZE))
+        size = 0
+        with open(filepath, "r") as input_file:
+            for address, word in HackAssembler().stream(input_file):
+                rom[address] = word or 0
+                size = max(size, address + 1)
+        return rom[:size]
+    return hack_rom.load(filepath)
+
+
+def to_signed(value: int) -> int:
+    return value - 0x10000 if value & 0x8000 else value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a Hack program headlessly")
+    parser.add_argument("program", help="filepath of .hack, .hackb or .asm")
+    parser.add_argument(
+        "--cycles", type=int, default=1_000_000, help="maximum number of cycles"
+    )
+    parser.add_argument(
+        "--set",
+        nargs="*",
+        default=[],
+        help="initialize RAM before running, e.g. 0=256 1=300",
+    )
+    parser.add_argument(
+        "--print",
+        nargs="*",
+        default=[],
+        help="RAM addresses or ranges to print after running, e.g. 0 256:260",
+    )
+    parser.add_argument(
+        "--jit",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="compile the program to Python functions as it runs",
+    )
+    args = parser.parse_args()
+
+    emulator = (JitEmulator if args.jit else HackEmulator)(load_program(args.program))
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        emulator.ram[int(address, 0)] = int(value, 0) & 0xFFFF
+    start = time.perf_counter()
+    emulator.run(args.cycles)
+    seconds = time.perf_counter() - start
+    print(
+        f"{emulator.cycles} cycles in {seconds:.3f}s"
+        f" ({emulator.cycles / max(seconds, 1e-9):,.0f} instructions/s)"
+        + (", halted" if emulator.halted else "")
+    )
+    for item in args.print:
+        first, _, last = item.partition(":")
+        for address in range(int(first, 0), int(last or first, 0) + 1):
+            print(f"RAM[{address}] = {to_signed(emulator.ram[address])}")
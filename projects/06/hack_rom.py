@@ -0,0 +1,84 @@
+import argparse
+import mmap
+import struct
+import sys
+from array import array
+from typing import BinaryIO, Iterable, Optional, Sequence
+
+# magic, format version, reserved, number of words
+HEADER = struct.Struct("<4sHHI")
+MAGIC = b"HACK"
+VERSION = 1
+
+
+def pack(words: Iterable[tuple[int, Optional[int]]]) -> array:
+    """
+    Collect (address, word) pairs into the ROM as 16-bit words. Words yielded out
+    of order (forward references) are patched in place, and words still unknown
+    are 0.
+    """
+    rom = array("H")
+    for address, word in words:
+        if address == len(rom):
+            rom.append(word or 0)
+        else:
+            rom[address] = word or 0
+    return rom
+
+
+def to_text(rom: Sequence[int]) -> bytes:
+    """
+    :return: the .hack text of packed words, one 16-character line per word
+    """
+    return "\n".join([format(word, "016b") for word in rom]).encode()
+
+
+def dump(rom: array, output_file: BinaryIO, output_format: str = "text"):
+    """
+    Write a whole ROM held in memory as "text" or "packed".
+    """
+    if output_format == "text":
+        output_file.write(to_text(rom))
+        return
+    output_file.write(HEADER.pack(MAGIC, VERSION, 0, len(rom)))
+    if sys.byteorder == "big":
+        rom = array("H", rom)
+        rom.byteswap()
+    output_file.write(rom.tobytes())
+
+
+def load(filepath: str) -> Sequence[int]:
+    """
+    Load a ROM image. Packed files are memory-mapped and returned as a read-only
+    view of 16-bit words without parsing; text .hack files are parsed into an array.
+    """
+    with open(filepath, "rb") as input_file:
+        if input_file.read(len(MAGIC)) != MAGIC:
+            input_file.seek(0)
+            return array("H", [int(line, 2) for line in input_file.read().split()])
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    _, version, _, size = HEADER.unpack_from(mapped)
+    if version != VERSION:
+        raise ValueError(f"Unsupported packed ROM version {version} in {filepath}")
+    if len(mapped) < HEADER.size + size * 2:
+        raise ValueError(f"Truncated packed ROM {filepath}")
+    if sys.byteorder == "big":
+        rom = array("H", mapped[HEADER.size : HEADER.size + size * 2])
+        rom.byteswap()
+        return rom
+    return memoryview(mapped)[HEADER.size : HEADER.size + size * 2].cast("H")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a packed Hack ROM image to a .hack text file"
+    )
+    parser.add_argument("rom", help="filepath of packed Hack ROM image")
+    args = parser.parse_args()
+
+    filepath: str = args.rom
+    assert filepath.endswith(".hackb"), f"{filepath} doesn't end with .hackb"
+
+    output: str = filepath[: -len(".hackb")] + ".hack"
+    with open(output, "wb") as output_file:
+        output_file.write(to_text(load(filepath)))
@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import os
+import struct
+import zlib
+from array import array
+from typing import Optional
+
+import numpy as np
+
+from hack_emulator import SCREEN, HackEmulator, JitEmulator, load_program
+
+WIDTH = 512
+HEIGHT = 256
+SCREEN_WORDS = WIDTH * HEIGHT // 16
+
+
+class Framebuffer:
+    """
+    NumPy view of the SCREEN memory map of a Hack RAM, without copying it. Each
+    row is 32 words and the least significant bit of a word is its leftmost pixel.
+    """
+
+    def __init__(self, ram: array):
+        self.__words = np.frombuffer(ram, dtype=np.uint16)[
+            SCREEN : SCREEN + SCREEN_WORDS
+        ]
+
+    def pixels(self) -> np.ndarray:
+        """
+        :return: HEIGHT x WIDTH array of uint8, 1 for a black pixel
+        """
+        little_endian = self.__words.astype("<u2", copy=False)
+        return np.unpackbits(little_endian.view(np.uint8), bitorder="little").reshape(
+            HEIGHT, WIDTH
+        )
+
+    def digest(self) -> str:
+        return hashlib.blake2b(self.__words.tobytes(), digest_size=16).hexdigest()
+
+    def write_pgm(self, filepath: str):
+        with open(filepath, "wb") as output_file:
+            output_file.write(f"P5 {WIDTH} {HEIGHT} 255\n".encode())
+            output_file.write(((1 - self.pixels()) * 255).astype(np.uint8).tobytes())
+
+    def write_png(self, filepath: str):
+        # 1-bit grayscale where 0 is black, each row prefixed by filter type 0
+        rows = np.packbits(1 - self.pixels(), axis=1)
+        data = np.hstack([np.zeros((HEIGHT, 1), dtype=np.uint8), rows]).tobytes()
+
+        def chunk(kind: bytes, body: bytes) -> bytes:
+            return (
+                struct.pack(">I", len(body))
+                + kind
+                + body
+                + struct.pack(">I", zlib.crc32(kind + body))
+            )
+
+        with open(filepath, "wb") as output_file:
+            output_file.write(b"\x89PNG\r\n\x1a\n")
+            output_file.write(
+                chunk(b"IHDR", struct.pack(">IIBBBBB", WIDTH, HEIGHT, 1, 0, 0, 0, 0))
+            )
+            output_file.write(chunk(b"IDAT", zlib.compress(data)))
+            output_file.write(chunk(b"IEND", b""))
+
+
+def record(
+    emulator: HackEmulator,
+    max_cycles: int,
+    every: int,
+    directory: Optional[str] = None,
+    image_format: str = "png",
+) -> list[tuple[int, str]]:
+    """
+    Run `emulator` and capture the screen every `every` cycles. If `directory` is
+    given, frames that differ from the previous capture are written into it.
+    :return: (cycle, screen digest) of every capture
+    """
+    framebuffer = Framebuffer(emulator.ram)
+    captures: list[tuple[int, str]] = []
+    while emulator.cycles < max_cycles and not emulator.halted:
+        emulator.run(min(every, max_cycles - emulator.cycles))
+        digest = framebuffer.digest()
+        if directory is not None and (not captures or captures[-1][1] != digest):
+            filepath = os.path.join(
+                directory, f"frame_{emulator.cycles:010d}.{image_format}"
+            )
+            if image_format == "png":
+                framebuffer.write_png(filepath)
+            else:
+                framebuffer.write_pgm(filepath)
+        captures.append((emulator.cycles, digest))
+    return captures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a Hack program headlessly and capture its screen"
+    )
+    parser.add_argument("program", help="filepath of .hack, .hackb or .asm")
+    parser.add_argument(
+        "--cycles", type=int, default=10_000_000, help="maximum number of cycles"
+    )
+    parser.add_argument(
+        "--every", type=int, default=100_000, help="cycles between two captures"
+    )
+    parser.add_argument("--output", help="directory to write changed frames into")
+    parser.add_argument("--format", choices=["png", "pgm"], default="png")
+    parser.add_argument(
+        "--jit",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="compile the program to Python functions as it runs",
+    )
+    args = parser.parse_args()
+
+    emulator = (JitEmulator if args.jit else HackEmulator)(load_program(args.program))
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    for cycle, digest in record(
+        emulator, args.cycles, args.every, args.output, args.format
+    ):
+        print(f"{cycle} {digest}")
@@ -0,0 +1,165 @@
+import argparse
+import bisect
+import json
+import os
+from array import array
+from typing import Optional
+
+VERSION = 1
+
+
+class SourceMap:
+    """
+    Map the positions of a generated file, ROM addresses or line numbers, to the
+    file and line they were generated from. A position maps to the entry at or
+    before it, so entries are only added where the source line changes, and are
+    kept in sorted arrays searched with bisect. With `step`, the line advances
+    with the position within an entry, as the lines of assembly code do with
+    ROM addresses, so an entry covers every instruction up to a label or comment.
+    """
+
+    def __init__(self, step: bool = False):
+        self.step = step
+        self.files: list[str] = []
+        self.positions = array("L")
+        # index in `files` of each entry, -1 for code generated from no source
+        self.sources = array("l")
+        self.lines = array("L")
+        self.__file_indexes: dict[str, int] = {}
+
+    def add(self, position: int, filepath: Optional[str], line: int = 0):
+        """
+        Map `position` and the positions after it to a line of `filepath`, or to
+        no source if it is None. Positions must be added in increasing order.
+        """
+        source = -1
+        if filepath is not None:
+            if filepath not in self.__file_indexes:
+                self.__file_indexes[filepath] = len(self.files)
+                self.files.append(filepath)
+            source = self.__file_indexes[filepath]
+        if self.positions and self.positions[-1] == position:
+            self.positions.pop()
+            self.sources.pop()
+            self.lines.pop()
+        if self.positions and self.sources[-1] == source:
+            expected = self.lines[-1]
+            if self.step:
+                expected += position - self.positions[-1]
+            if line == expected:
+                return
+        self.positions.append(position)
+        self.sources.append(source)
+        self.lines.append(line)
+
+    def shift(self, offset: int):
+        """
+        Move every entry by `offset` positions, e.g. for code inserted before.
+        """
+        self.positions = array("L", (position + offset for position in self.positions))
+
+    def extend(self, other: "SourceMap", offset: int, files: list[str]):
+        """
+        Add the entries of `other`, a map of code generated apart, moved by
+        `offset` positions and with `files` for its files.
+        """
+        for position, source, line in zip(other.positions, other.sources, other.lines):
+            self.add(position + offset, files[source] if source >= 0 else None, line)
+
+    def lookup(self, position: int) -> Optional[tuple[str, int]]:
+        """
+        :return: the file and line `position` was generated from, None if unknown
+        """
+        idx = bisect.bisect_right(self.positions, position) - 1
+        if idx < 0 or self.sources[idx] < 0:
+            return None
+        line = self.lines[idx]
+        if self.step:
+            line += position - self.positions[idx]
+        return self.files[self.sources[idx]], line
+
+    def write(self, filepath: str):
+        """
+        Save as JSON, with the files relative to the directory of `filepath`.
+        """
+        directory = os.path.dirname(os.path.abspath(filepath))
+        with open(filepath, "w") as output_file:
+            json.dump(
+                {
+                    "version": VERSION,
+                    "step": self.step,
+                    "files": [
+                        os.path.relpath(os.path.abspath(path), directory)
+                        for path in self.files
+                    ],
+                    "positions": self.positions.tolist(),
+                    "sources": self.sources.tolist(),
+                    "lines": self.lines.tolist(),
+                },
+                output_file,
+                separators=(",", ":"),
+            )
+
+
+def read(filepath: str) -> SourceMap:
+    with open(filepath, "r") as input_file:
+        data = json.load(input_file)
+    assert data["version"] == VERSION, f"Unsupported source map version in {filepath}"
+    directory = os.path.dirname(os.path.abspath(filepath))
+    source_map = SourceMap(data["step"])
+    source_map.files = [os.path.join(directory, path) for path in data["files"]]
+    source_map.positions = array("L", data["positions"])
+    source_map.sources = array("l", data["sources"])
+    source_map.lines = array("L", data["lines"])
+    return source_map
+
+
+class SourceMapChain:
+    """
+    Follow a position through the maps of every stage: the map of a generated
+    file is `{file}.map`, and the files it maps to may have maps of their own.
+    Maps are read once, when first needed.
+    """
+
+    def __init__(self):
+        self.__maps: dict[str, Optional[SourceMap]] = {}
+
+    def resolve(self, filepath: str, position: int) -> list[tuple[str, int]]:
+        """
+        :return: the file and line at each stage, from `filepath` to the original
+            source
+        """
+        result = []
+        while True:
+            source_map = self.__map(filepath)
+            location = source_map.lookup(position) if source_map else None
+            if location is None:
+                return result
+            result.append(location)
+            filepath, position = location
+
+    def __map(self, filepath: str) -> Optional[SourceMap]:
+        if filepath not in self.__maps:
+            path = f"{filepath}.map"
+            self.__maps[filepath] = read(path) if os.path.exists(path) else None
+        return self.__maps[filepath]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print the sources of ROM addresses or lines of generated code"
+    )
+    parser.add_argument("file", help="a generated file with a .map next to it")
+    parser.add_argument("positions", type=int, nargs="+", help="addresses or lines")
+    args = parser.parse_args()
+
+    chain = SourceMapChain()
+    filepath = os.path.abspath(args.file)
+    for position in args.positions:
+        locations = chain.resolve(filepath, position)
+        print(
+            " -> ".join(
+                [str(position)]
+                + [f"{os.path.relpath(path)}:{line}" for path, line in locations]
+            )
+        )
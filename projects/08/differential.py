@@ -0,0 +1,288 @@
+import argparse
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+
+import vm_linker
+from vm_interpreter import read_cmp
+from vm_translator import VMTranslator, bootstrap, shared_routines
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "..", "06"))
+
+from hack_assembler import HackAssembler  # noqa: E402
+from hack_emulator import KBD, HackEmulator, JitEmulator, to_signed  # noqa: E402
+
+TESTS = sorted(
+    filepath
+    for filepath in glob.glob(os.path.join(HERE, "..", "07", "*", "*", "*.tst"))
+    + glob.glob(os.path.join(HERE, "*", "*", "*.tst"))
+    if not filepath.endswith("VME.tst")
+)
+JACK_PROGRAMS = sorted(
+    os.path.dirname(filepath)
+    for filepath in glob.glob(os.path.join(HERE, "..", "11", "*", "Main.jack"))
+)
+# with the OS, only builds like this one fit in the 32K ROM; both builds of a
+# projects/11 program use these options on top of the given ones
+JACK_OPTIONS = {
+    "direct_arithmetic": True,
+    "shared_routines": True,
+    "prune_functions": True,
+}
+# RAM set before running a projects/11 program, by program
+JACK_RAM = {"ConvertToBin": {8000: 0x2A5B}}
+# programs are stopped on entering these, so the ones waiting for a key are
+# compared when they first poll the keyboard
+STOP_FUNCTIONS = ["Sys.halt", "Keyboard.keyPressed"]
+
+
+def load_test(filepath: str) -> tuple[list[str], dict[int, int], dict[int, int]]:
+    """
+    :return: the VM files of a test script, the RAM it sets and the RAM values
+        expected by its .cmp file
+    """
+    directory = os.path.dirname(filepath)
+    with open(filepath, "r") as tst_file:
+        ram = {
+            int(address): int(value)
+            for address, value in re.findall(
+                r"set RAM\[(\d+)\]\s+(-?\d+)", tst_file.read()
+            )
+        }
+    expected = read_cmp(filepath[: -len(".tst")] + ".cmp")
+    return sorted(glob.glob(os.path.join(directory, "*.vm"))), ram, expected
+
+
+def translate(
+    vm_files: list[str],
+    sp: Optional[int],
+    prune_functions: bool = False,
+    static_frames: bool = False,
+    inline: int = 0,
+    **options,
+) -> list[str]:
+    """
+    Translate like the CLI with --booting. STOP_FUNCTIONS are never inlined.
+    """
+    if prune_functions:
+        calls, _ = vm_linker.scan(vm_files)
+        if "Sys.init" in calls:
+            options["functions"] = vm_linker.reachable(calls)
+    if inline > 0:
+        options["inline"] = {
+            name: leaf
+            for name, leaf in vm_linker.leaf_functions(vm_files, inline).items()
+            if name not in STOP_FUNCTIONS
+        }
+    if static_frames:
+        options["frames"] = vm_linker.allocate_frames(
+            vm_files, leaves=options.get("inline")
+        )
+    asm_code: list[str] = []
+    translators: list[VMTranslator] = []
+    for vm_file in vm_files:
+        translator = VMTranslator(
+            filename=os.path.splitext(os.path.basename(vm_file))[0], **options
+        )
+        translators.append(translator)
+        with open(vm_file, "r") as input_file:
+            asm_code.extend(translator.translate(input_file))
+    if any(translator.has_sys_init for translator in translators):
+        asm_code = bootstrap(sp) + asm_code
+    if options.get("shared_routines"):
+        asm_code.extend(shared_routines())
+    return asm_code
+
+
+def run(
+    filepath: str, max_cycles: int, **options
+) -> tuple[int, int, list[tuple[int, int, int]]]:
+    """
+    Run until the program halts in an infinite loop or leaves the ROM, e.g. by
+    returning from a function that wasn't called.
+
+    :return: ROM size, cycles until the program stops and the (address, actual,
+        expected) RAM values that don't match
+    """
+    vm_files, ram, expected = load_test(filepath)
+    rom = HackAssembler().assemble(translate(vm_files, 261, **options), 1)
+    emulator = HackEmulator(rom)
+    for address, value in ram.items():
+        emulator.ram[address] = value & 0xFFFF
+    while (
+        emulator.cycles < max_cycles and not emulator.halted and emulator.pc < len(rom)
+    ):
+        emulator.run(1)
+    mismatches = [
+        (address, to_signed(emulator.ram[address]), value)
+        for address, value in expected.items()
+        if to_signed(emulator.ram[address]) != value
+    ]
+    return len(rom), emulator.cycles, mismatches
+
+
+def compile_jack(directory: str, output_directory: str) -> list[str]:
+    """
+    Compile a projects/11 program with the projects/12 OS using projects/11.
+    :return: the VM files
+    """
+    for jack_file in glob.glob(os.path.join(directory, "*.jack")) + glob.glob(
+        os.path.join(HERE, "..", "12", "*.jack")
+    ):
+        shutil.copy(jack_file, output_directory)
+    subprocess.run(
+        [sys.executable, os.path.join(HERE, "..", "11", "parser.py"), output_directory],
+        check=True,
+    )
+    return sorted(glob.glob(os.path.join(output_directory, "*.vm")))
+
+
+def run_program(
+    vm_files: list[str], ram: dict[int, int], max_cycles: int, **options
+) -> tuple[int, int, Optional[list[int]]]:
+    """
+    Run until the program enters one of STOP_FUNCTIONS.
+
+    :return: ROM size, cycles and the statics, heap and screen at that point, None
+        if it isn't reached within `max_cycles`
+    """
+    asm_code: list[str] = []
+    for line in translate(vm_files, 256, **options):
+        asm_code.append(line)
+        if line[1:-1] in STOP_FUNCTIONS:
+            asm_code.extend(["(DIFFERENTIAL$STOP)", "@DIFFERENTIAL$STOP", "0;JMP"])
+    rom = HackAssembler().assemble(asm_code, 1)
+    emulator = JitEmulator(rom)
+    for address, value in ram.items():
+        emulator.ram[address] = value & 0xFFFF
+    emulator.run(max_cycles)
+    if not emulator.halted:
+        return len(rom), emulator.cycles, None
+    return (
+        len(rom),
+        emulator.cycles,
+        list(emulator.ram[16:256]) + list(emulator.ram[2048:KBD]),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the projects/07 and 08 test programs translated with and "
+        "without the given options, and compare with the expected RAM"
+    )
+    parser.add_argument(
+        "--direct-arithmetic",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="compute arithmetic in place on the stack top",
+    )
+    parser.add_argument(
+        "--shared-routines",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="emit call, return and comparisons once and jump to them",
+    )
+    parser.add_argument(
+        "--optimize",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="fold constants and remove redundant VM commands before translating",
+    )
+    parser.add_argument(
+        "--prune-functions",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="drop the functions that are never called from Sys.init",
+    )
+    parser.add_argument(
+        "--fuse",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="translate common VM command sequences as superinstructions",
+    )
+    parser.add_argument(
+        "--cache-top",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="keep the stack top in the D register within basic blocks",
+    )
+    parser.add_argument(
+        "--static-frames",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="give fixed RAM to the locals and arguments of non-recursive functions",
+    )
+    parser.add_argument(
+        "--inline",
+        type=int,
+        default=0,
+        help="inline the functions of at most N VM commands that call no other",
+    )
+    parser.add_argument(
+        "--jack",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="also compare the projects/11 programs compiled with the projects/12 OS",
+    )
+    parser.add_argument(
+        "--cycles", type=int, default=1_000_000, help="maximum cycles per program"
+    )
+    parser.add_argument(
+        "--jack-cycles",
+        type=int,
+        default=500_000_000,
+        help="maximum cycles per projects/11 program",
+    )
+    args = parser.parse_args()
+
+    options = {
+        "direct_arithmetic": args.direct_arithmetic,
+        "shared_routines": args.shared_routines,
+        "optimize": args.optimize,
+        "prune_functions": args.prune_functions,
+        "fuse": args.fuse,
+        "cache_top": args.cache_top,
+        "static_frames": args.static_frames,
+        "inline": args.inline,
+    }
+    print(f"{'test':<20}{'rom':>8}{'rom opt':>9}{'cycles':>11}{'cycles opt':>12}")
+    failures = 0
+    for filepath in TESTS:
+        name = os.path.basename(filepath)[: -len(".tst")]
+        rom, cycles, mismatches = run(filepath, args.cycles)
+        rom_opt, cycles_opt, mismatches_opt = run(filepath, args.cycles, **options)
+        print(f"{name:<20}{rom:>8}{rom_opt:>9}{cycles:>11}{cycles_opt:>12}")
+        for mode, errors in [("default", mismatches), ("optimized", mismatches_opt)]:
+            for address, actual, value in errors:
+                print(f"  FAIL {mode}: RAM[{address}] is {actual}, expected {value}")
+                failures += 1
+    for directory in JACK_PROGRAMS if args.jack else []:
+        name = os.path.basename(directory)
+        with tempfile.TemporaryDirectory() as output_directory:
+            vm_files = compile_jack(directory, output_directory)
+            ram = JACK_RAM.get(name, {})
+            rom, cycles, memory = run_program(
+                vm_files, ram, args.jack_cycles, **JACK_OPTIONS
+            )
+            rom_opt, cycles_opt, memory_opt = run_program(
+                vm_files,
+                ram,
+                args.jack_cycles,
+                **{**options, **JACK_OPTIONS},
+            )
+        print(f"{name:<20}{rom:>8}{rom_opt:>9}{cycles:>11}{cycles_opt:>12}")
+        if memory is None or memory_opt is None:
+            print(f"  FAIL: {', '.join(STOP_FUNCTIONS)} not reached")
+            failures += 1
+            continue
+        differences = sum(x != y for x, y in zip(memory, memory_opt))
+        if differences:
+            print(f"  FAIL: {differences} words of statics, heap and screen differ")
+            failures += 1
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,453 @@
+from array import array
+from typing import Callable, Optional
+
+TRUE = 0xFFFF
+# past this depth, the recursion of the Jack version doesn't end or overflows
+MAX_DEPTH = 256
+# multiplications and writes of a builtin, past which it is left to the VM code
+# so that it stops with the interpreter after its number of steps
+MAX_WORK = 1_000_000
+
+
+# the statics the builtins of each OS class read or write, by index in its .vm
+# file, with the projects/12 function that sets each
+STATICS: dict[str, dict[int, str]] = {
+    # bits
+    "Math": {0: "Math.init"},
+    # ram, heap, freeList
+    "Memory": {0: "Memory.init", 1: "Memory.init", 2: "Memory.init"},
+    "Array": {},
+    "String": {},
+    # screen, currColor
+    "Screen": {0: "Screen.init", 1: "Screen.init"},
+    # charMaps, cursorX, cursorY, screen
+    "Output": {
+        0: "Output.initMap",
+        1: "Output.init",
+        2: "Output.init",
+        3: "Output.init",
+    },
+}
+# the classes whose builtins the builtins of each class call
+USES: dict[str, set[str]] = {
+    "Math": set(),
+    "Memory": set(),
+    "Array": {"Memory"},
+    "String": {"Math", "Memory", "Array"},
+    "Screen": {"Math"},
+    "Output": {"Math", "Memory", "Array"},
+}
+
+
+def incompatible_classes(statics: dict[str, dict[int, set[str]]]) -> set[str]:
+    """
+    :param statics: the functions that pop each static of every loaded class, by
+        index, with no function for the statics that are only pushed
+    :return: the OS classes whose builtins would read the wrong statics, since
+        their statics, or those of a class they call, aren't numbered and set
+        like in the projects/12 OS
+    """
+    result = {
+        name
+        for name, expected in STATICS.items()
+        if name in statics
+        and (
+            statics[name].keys() != expected.keys()
+            or any(
+                function not in statics[name][index]
+                for index, function in expected.items()
+            )
+        )
+    }
+    return result | {name for name, uses in USES.items() if uses & result}
+
+
+class Fallback(Exception):
+    """
+    Raised by a builtin when the Jack version wouldn't return, e.g. recursing
+    forever on a division by 0, or would take too long. Its writes are undone
+    and the Jack version runs.
+    """
+
+
+def signed(value: int) -> int:
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class OperatingSystem:
+    """
+    Python versions of the projects/12 OS functions as compiled by projects/11.
+    Arguments and results are 16-bit words, and the statics, heap and screen are
+    read and written in the same order as the VM code, including what it does
+    differently from the Jack source: operators have no precedence, so
+    `len < size + 1` in Memory.alloc is `(len < size) + 1`, and `if` and `while`
+    only take a branch for true, i.e. -1.
+    """
+
+    def __init__(self, ram: array, static_address: Callable[[str], int]):
+        self.ram = ram
+        self.__static_address = static_address
+        # address and previous value of every write of the current builtin
+        self.__writes: list[tuple[int, int]] = []
+        self.__work = 0
+        self.calls = 0
+        self.fallbacks = 0
+
+    def call(self, function: Callable[..., int], args: array) -> Optional[int]:
+        """
+        :return: the result of the builtin, None if the Jack version must run
+        """
+        self.__writes.clear()
+        self.__work = 0
+        try:
+            result = function(self, *args)
+        except Fallback:
+            for address, value in reversed(self.__writes):
+                self.ram[address] = value
+            self.fallbacks += 1
+            return None
+        self.calls += 1
+        return result & 0xFFFF
+
+    def __peek(self, address: int) -> int:
+        return self.ram[address & 0x7FFF]
+
+    def __poke(self, address: int, value: int):
+        self.__charge()
+        address &= 0x7FFF
+        self.__writes.append((address, self.ram[address]))
+        self.ram[address] = value & 0xFFFF
+
+    def __charge(self):
+        self.__work += 1
+        if self.__work > MAX_WORK:
+            raise Fallback
+
+    def __load(self, symbol: str) -> int:
+        return self.ram[self.__static_address(symbol)]
+
+    def __store(self, symbol: str, value: int):
+        self.__poke(self.__static_address(symbol), value)
+
+    def math_power2(self, i: int) -> int:
+        return self.__peek(self.__load("Math.0") + i)
+
+    def math_bit(self, x: int, i: int) -> int:
+        return 0 if (self.__peek(self.__load("Math.0") + i) & x) == 0 else TRUE
+
+    def math_abs(self, x: int) -> int:
+        return -x & 0xFFFF if signed(x) < 0 else x & 0xFFFF
+
+    def math_multiply(self, x: int, y: int) -> int:
+        # adds x shifted by i when bits[i] & y, whatever Math.init left in bits
+        self.__charge()
+        bits = self.__load("Math.0")
+        result = 0
+        for i in range(16):
+            if self.__peek(bits + i) & y:
+                result += x
+            x += x
+        return result & 0xFFFF
+
+    def math_divide(self, x: int, y: int) -> int:
+        result = self.math_divide_positive_only(self.math_abs(x), self.math_abs(y))
+        if (signed(x) > 0) == (signed(y) > 0):
+            return result
+        return -result & 0xFFFF
+
+    def math_divide_positive_only(self, x: int, y: int) -> int:
+        # the divisor of each recursive call, down to the one where x < y
+        divisors = [y]
+        while signed(x) >= signed(divisors[-1]):
+            if len(divisors) > MAX_DEPTH:
+                raise Fallback
+            divisors.append(self.math_multiply(2, divisors[-1]))
+        q = 0
+        for y in reversed(divisors[:-1]):
+            if signed(self.math_multiply(self.math_multiply(q, 2), y) + y) > signed(x):
+                q = self.math_multiply(2, q)
+            else:
+                q = (self.math_multiply(2, q) + 1) & 0xFFFF
+        return q
+
+    def math_sqrt(self, x: int) -> int:
+        result = 0
+        for i in range(7, -1, -1):
+            tmp = (result + self.__peek(self.__load("Math.0") + i)) & 0xFFFF
+            square = signed(self.math_multiply(tmp, tmp))
+            if square > 0 and not square > signed(x):
+                result = tmp
+        return result
+
+    def math_max(self, a: int, b: int) -> int:
+        return a if signed(a) > signed(b) else b
+
+    def math_min(self, a: int, b: int) -> int:
+        return b if signed(a) > signed(b) else a
+
+    def memory_peek(self, address: int) -> int:
+        return self.__peek(self.__load("Memory.0") + address)
+
+    def memory_poke(self, address: int, value: int) -> int:
+        self.__poke(self.__load("Memory.0") + address, value)
+        return 0
+
+    def memory_alloc(self, size: int) -> int:
+        curr = self.__load("Memory.2")
+        # a free list with more blocks than there are words has a cycle
+        for _ in range(0x10000):
+            if curr == 0:
+                return self.__load("Memory.2")
+            following = self.__peek(self.__load("Memory.0") + curr)
+            length = self.__peek(self.__load("Memory.0") + curr + 1)
+            # `~((len < size) + 1)` holds when len < size
+            if signed(length) < signed(size):
+                self.__poke(self.__load("Memory.0") + curr, size)
+                self.__store("Memory.2", curr + size + 1)
+                free_list = self.__load("Memory.2")
+                self.__poke(self.__load("Memory.0") + free_list, following)
+                self.__poke(
+                    self.__load("Memory.0") + free_list + 1, length - (size + 1)
+                )
+                return (curr + 1) & 0xFFFF
+            curr = following
+        raise Fallback
+
+    def memory_de_alloc(self, o: int) -> int:
+        curr = (o - 1) & 0xFFFF
+        size = self.__peek(self.__load("Memory.0") + curr)
+        self.__poke(self.__load("Memory.0") + curr, self.__load("Memory.2"))
+        self.__poke(self.__load("Memory.0") + curr + 1, size - 1)
+        self.__store("Memory.2", curr)
+        return 0
+
+    def array_new(self, size: int) -> int:
+        return self.memory_alloc(size)
+
+    def array_dispose(self, this: int) -> int:
+        return self.memory_de_alloc(this)
+
+    def string_new(self, max_length: int) -> int:
+        # the constructor allocates the 3 fields first
+        this = self.memory_alloc(3)
+        max_length = self.math_max(1, max_length)
+        self.__poke(this, self.array_new(max_length))
+        self.__poke(this + 1, max_length)
+        self.__poke(this + 2, 0)
+        return this
+
+    def string_dispose(self, this: int) -> int:
+        return self.array_dispose(self.__peek(this))
+
+    def string_length(self, this: int) -> int:
+        return self.__peek(this + 2)
+
+    def string_char_at(self, this: int, j: int) -> int:
+        return self.__peek(self.__peek(this) + j)
+
+    def string_set_char_at(self, this: int, j: int, c: int) -> int:
+        self.__poke(self.__peek(this) + j, c)
+        return 0
+
+    def string_append_char(self, this: int, c: int) -> int:
+        self.__poke(self.__peek(this) + self.__peek(this + 2), c)
+        self.__poke(this + 2, self.__peek(this + 2) + 1)
+        return this
+
+    def string_erase_last_char(self, this: int) -> int:
+        self.__poke(this + 2, self.__peek(this + 2) - 1)
+        return 0
+
+    def string_int_value(self, this: int) -> int:
+        negative = self.__peek(self.__peek(this)) == 45
+        i = 1 if negative else 0
+        result = 0
+        while signed(i) < signed(self.__peek(this + 2)):
+            digit = self.__peek(self.__peek(this) + i)
+            result = (self.math_multiply(result, 10) + digit - 48) & 0xFFFF
+            i += 1
+        return -result & 0xFFFF if negative else result
+
+    def string_set_int(self, this: int, val: int) -> int:
+        self.__poke(this + 2, 0)
+        if signed(val) < 0:
+            self.string_append_char(this, 45)
+        return self.string_set_int_positive_only(this, self.math_abs(val))
+
+    def string_set_int_positive_only(self, this: int, val: int) -> int:
+        # the last digit of each recursive call, appended as they return
+        digits: list[int] = []
+        while True:
+            if len(digits) > MAX_DEPTH:
+                raise Fallback
+            digits.append(val - self.math_multiply(self.math_divide(val, 10), 10))
+            if signed(val) < 10:
+                break
+            val = self.math_divide(val, 10)
+        for digit in reversed(digits):
+            self.string_append_char(this, digit + 48)
+        return 0
+
+    def string_new_line(self) -> int:
+        return 128
+
+    def string_back_space(self) -> int:
+        return 129
+
+    def string_double_quote(self) -> int:
+        return 34
+
+    def screen_clear_screen(self) -> int:
+        for i in range(8192):
+            self.__poke(self.__load("Screen.0") + i, 0)
+        return 0
+
+    def screen_set_color(self, b: int) -> int:
+        self.__store("Screen.1", b)
+        return 0
+
+    def screen_draw_pixel(self, x: int, y: int) -> int:
+        address = self.math_multiply(32, y) + self.math_divide(x, 16)
+        pos = x - self.math_multiply(self.math_divide(x, 16), 16)
+        power2 = 1
+        i = 0
+        while i < signed(pos):
+            power2 = self.math_multiply(power2, 2)
+            i += 1
+        word = self.__peek(self.__load("Screen.0") + address)
+        if self.__load("Screen.1") == TRUE:
+            self.__poke(self.__load("Screen.0") + address, word | power2)
+        else:
+            self.__poke(self.__load("Screen.0") + address, word & ~power2)
+        return 0
+
+    def screen_draw_line(self, x1: int, y1: int, x2: int, y2: int) -> int:
+        if signed(x1) > signed(x2):
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        dy = 1 if signed(y1) < signed(y2) else TRUE
+        a = 0
+        b = 0
+        # a and b only move toward x2 - x1 and y2 - y1, so this ends
+        while (x1 + a) & 0xFFFF != x2 or (y1 + b) & 0xFFFF != y2:
+            self.screen_draw_pixel((x1 + a) & 0xFFFF, (y1 + b) & 0xFFFF)
+            if (x1 + a) & 0xFFFF == x2:
+                b = (b + dy) & 0xFFFF
+            elif (y1 + b) & 0xFFFF == y2:
+                a = (a + 1) & 0xFFFF
+            else:
+                tmp = signed(
+                    self.math_multiply(y2 - y1, x2 - x1 - a)
+                    - self.math_multiply(y2 - y1 - b, x2 - x1)
+                )
+                if (signed(y1) < signed(y2)) == (tmp < 0):
+                    b = (b + dy) & 0xFFFF
+                else:
+                    a = (a + 1) & 0xFFFF
+        return 0
+
+    def screen_draw_rectangle(self, x1: int, y1: int, x2: int, y2: int) -> int:
+        if signed(x2) == 0x7FFF:
+            # x1 > x2 never holds
+            raise Fallback
+        while not signed(x1) > signed(x2):
+            self.screen_draw_line(x1, y1, x1, y2)
+            x1 = (x1 + 1) & 0xFFFF
+        return 0
+
+    def screen_draw_circle(self, x: int, y: int, r: int) -> int:
+        if signed(r) == 0x7FFF:
+            # dy > r never holds
+            raise Fallback
+        dy = -r & 0xFFFF
+        while not signed(dy) > signed(r):
+            dx = self.math_sqrt(self.math_multiply(r, r) - self.math_multiply(dy, dy))
+            self.screen_draw_line(x - dx, y + dy, x + dx, y + dy)
+            dy = (dy + 1) & 0xFFFF
+        return 0
+
+    def output_create(self, index: int, *rows: int) -> int:
+        char_map = self.array_new(11)
+        self.__poke(self.__load("Output.0") + index, char_map)
+        for i, row in enumerate(rows):
+            self.__poke(char_map + i, row)
+        return 0
+
+    def output_get_map(self, c: int) -> int:
+        if signed(c) < 32 or signed(c) > 126:
+            c = 0
+        return self.__peek(self.__load("Output.0") + c)
+
+    def output_print_char(self, c: int) -> int:
+        char_map = self.output_get_map(c)
+        # 512 / 16 * 11 and 512 / 16 are computed by Math.divide at every use
+        address = self.math_multiply(
+            self.__load("Output.2"),
+            self.math_multiply(self.math_divide(512, 16), 11),
+        ) + self.math_divide(self.math_multiply(self.__load("Output.1"), 8), 16)
+        for i in range(11):
+            bit = self.__peek(char_map + i)
+            if (self.__load("Output.1") & 1) == 0:
+                mask = self.math_multiply(256, 255)
+            else:
+                bit = self.math_multiply(bit, 256)
+                mask = 255
+            word = self.__peek(self.__load("Output.3") + address)
+            self.__poke(self.__load("Output.3") + address, (word & mask) | bit)
+            address += self.math_divide(512, 16)
+        if signed(self.__load("Output.1")) < 63:
+            self.__store("Output.1", self.__load("Output.1") + 1)
+        else:
+            self.output_println()
+        return 0
+
+    def output_println(self) -> int:
+        self.__store("Output.1", 0)
+        if signed(self.__load("Output.2")) < 22:
+            self.__store("Output.2", self.__load("Output.2") + 1)
+        else:
+            self.__store("Output.2", 0)
+        return 0
+
+
+# OS functions that can run in Python, by VM function name
+BUILTINS: dict[str, Callable[..., int]] = {
+    "Math.Power2": OperatingSystem.math_power2,
+    "Math.bit": OperatingSystem.math_bit,
+    "Math.abs": OperatingSystem.math_abs,
+    "Math.multiply": OperatingSystem.math_multiply,
+    "Math.divide": OperatingSystem.math_divide,
+    "Math.dividePositiveOnly": OperatingSystem.math_divide_positive_only,
+    "Math.sqrt": OperatingSystem.math_sqrt,
+    "Math.max": OperatingSystem.math_max,
+    "Math.min": OperatingSystem.math_min,
+    "Memory.peek": OperatingSystem.memory_peek,
+    "Memory.poke": OperatingSystem.memory_poke,
+    "Memory.alloc": OperatingSystem.memory_alloc,
+    "Memory.deAlloc": OperatingSystem.memory_de_alloc,
+    "Array.new": OperatingSystem.array_new,
+    "Array.dispose": OperatingSystem.array_dispose,
+    "String.new": OperatingSystem.string_new,
+    "String.dispose": OperatingSystem.string_dispose,
+    "String.length": OperatingSystem.string_length,
+    "String.charAt": OperatingSystem.string_char_at,
+    "String.setCharAt": OperatingSystem.string_set_char_at,
+    "String.appendChar": OperatingSystem.string_append_char,
+    "String.eraseLastChar": OperatingSystem.string_erase_last_char,
+    "String.intValue": OperatingSystem.string_int_value,
+    "String.setInt": OperatingSystem.string_set_int,
+    "String.setIntPositiveOnly": OperatingSystem.string_set_int_positive_only,
+    "String.newLine": OperatingSystem.string_new_line,
+    "String.backSpace": OperatingSystem.string_back_space,
+    "String.doubleQuote": OperatingSystem.string_double_quote,
+    "Screen.clearScreen": OperatingSystem.screen_clear_screen,
+    "Screen.setColor": OperatingSystem.screen_set_color,
+    "Screen.drawPixel": OperatingSystem.screen_draw_pixel,
+    "Screen.drawLine": OperatingSystem.screen_draw_line,
+    "Screen.drawRectangle": OperatingSystem.screen_draw_rectangle,
+    "Screen.drawCircle": OperatingSystem.screen_draw_circle,
+    "Output.create": OperatingSystem.output_create,
+    "Output.getMap": OperatingSystem.output_get_map,
+    "Output.printChar": OperatingSystem.output_print_char,
+    "Output.println": OperatingSystem.output_println,
+}
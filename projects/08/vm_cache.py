@@ -0,0 +1,134 @@
+import hashlib
+import os
+import pickle
+import re
+from typing import Any, Optional
+
+from vm_ir import Instruction
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the code generation depends on these modules, so they version the entries
+TRANSLATOR_SOURCES = ["vm_translator.py", "vm_ir.py", "vm_optimizer.py", "vm_linker.py"]
+FUNCTION_NAMES = re.compile(rb"^\s*(?:function|call)\s+(\S+)", re.MULTILINE)
+
+
+def translator_version() -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for source in TRANSLATOR_SOURCES:
+        with open(os.path.join(HERE, source), "rb") as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def file_options(options: dict, names: set[str]) -> dict:
+    """
+    :return: the options a file is translated with, where the functions to keep,
+        the static frames and the inlined bodies are by function name, reduced
+        to the functions the file defines or calls
+    """
+    result = {}
+    for key, value in options.items():
+        if isinstance(value, dict):
+            value = {name: item for name, item in value.items() if name in names}
+        elif isinstance(value, (set, frozenset)):
+            value = value & names
+        result[key] = value
+    return result
+
+
+def canonical(value: Any) -> str:
+    """
+    :return: the same text for equal options, whatever the order of their sets
+        and dicts
+    """
+    if isinstance(value, Instruction):
+        return str(value)
+    if isinstance(value, dict):
+        items = sorted((canonical(key), canonical(item)) for key, item in value.items())
+        return "{" + ",".join(f"{key}:{item}" for key, item in items) + "}"
+    if isinstance(value, (set, frozenset)):
+        return "{" + ",".join(sorted(canonical(item) for item in value)) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(canonical(item) for item in value) + "]"
+    if hasattr(value, "__slots__"):
+        return canonical([getattr(value, slot) for slot in value.__slots__])
+    return repr(value)
+
+
+class TranslationCache:
+    """
+    The translations of whole .vm files on disk, keyed by the file name and
+    content, the translator sources and the options. Options computed for the
+    whole program only count for the functions of the file, so that editing a
+    class doesn't invalidate the others unless the static frames or inlined
+    bodies they use change. Entries are evicted least recently used first when
+    there are more than `max_entries` or they take more than `max_bytes`.
+    """
+
+    def __init__(self, directory: str, options: dict, max_bytes: int, max_entries: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__options = options
+        self.__version = translator_version().encode()
+        self.__keys: dict[str, str] = {}
+
+    def get(self, vm_file: str) -> Optional[tuple]:
+        """
+        :return: the result of vm_translator._translate_file, None on a miss
+        """
+        path = self.__path(vm_file)
+        try:
+            with open(path, "rb") as entry_file:
+                result = pickle.load(entry_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # the modification time orders entries by last use
+        os.utime(path)
+        self.hits += 1
+        return result
+
+    def put(self, vm_file: str, result: tuple):
+        path = self.__path(vm_file)
+        # written under another name first so that a reader never sees half of it
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as entry_file:
+            pickle.dump(result, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    def evict(self) -> int:
+        """
+        :return: the number of entries removed
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        entries.sort(reverse=True)
+        removed = 0
+        size = 0
+        for count, (_, entry_size, name) in enumerate(entries, 1):
+            size += entry_size
+            if count > self.max_entries or size > self.max_bytes:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+        return removed
+
+    def __path(self, vm_file: str) -> str:
+        if vm_file not in self.__keys:
+            with open(vm_file, "rb") as input_file:
+                content = input_file.read()
+            names = {name.decode() for name in FUNCTION_NAMES.findall(content)}
+            options = canonical(file_options(self.__options, names))
+            digest = hashlib.blake2b(self.__version, digest_size=16)
+            # statics and labels are named after the file
+            digest.update(os.path.basename(vm_file).encode() + b"\0")
+            digest.update(options.encode() + b"\0")
+            digest.update(content)
+            self.__keys[vm_file] = digest.hexdigest()
+        return os.path.join(self.directory, f"{self.__keys[vm_file]}.pickle")
@@ -0,0 +1,540 @@
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+from array import array
+from typing import Callable, Iterable
+
+import vm_ir
+from vm_builtins import BUILTINS, OperatingSystem, incompatible_classes
+from vm_ir import Instruction, Op, Segment
+from vm_optimizer import split_functions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAM_SIZE = 0x8000
+KBD = 0x6000
+# segment pointers in RAM, as named by `set sp 256` in VM emulator scripts
+POINTERS = {"sp": 0, "local": 1, "argument": 2, "this": 3, "that": 4}
+BASES = {
+    Segment.LOCAL: POINTERS["local"],
+    Segment.ARGUMENT: POINTERS["argument"],
+    Segment.THIS: POINTERS["this"],
+    Segment.THAT: POINTERS["that"],
+}
+VME_TESTS = sorted(
+    glob.glob(os.path.join(HERE, "..", "07", "*", "*", "*VME.tst"))
+    + glob.glob(os.path.join(HERE, "*", "*", "*VME.tst"))
+)
+
+# commands are resolved at load time to these codes: segments to a fixed address
+# or a pointer, labels and functions to indexes. Labels aren't kept, they aren't
+# steps of the VM emulator either
+(
+    PUSH_CONSTANT,
+    PUSH_FIXED,
+    PUSH_BASED,
+    POP_FIXED,
+    POP_BASED,
+    ADD,
+    SUB,
+    NEG,
+    EQ,
+    GT,
+    LT,
+    AND,
+    OR,
+    NOT,
+    GOTO,
+    IF_GOTO,
+    FUNCTION,
+    CALL,
+    RETURN,
+    HALT,
+    # a call of a builtin, which runs the function in Python
+    NATIVE,
+) = range(21)
+ARITHMETIC = {
+    Op.ADD: ADD,
+    Op.SUB: SUB,
+    Op.NEG: NEG,
+    Op.EQ: EQ,
+    Op.GT: GT,
+    Op.LT: LT,
+    Op.AND: AND,
+    Op.OR: OR,
+    Op.NOT: NOT,
+}
+
+
+class VMInterpreter:
+    """
+    Run VM code without translating it. RAM holds 16-bit words like the Hack
+    computer, with the stack and the segment pointers at the usual addresses, and
+    a return address is the index of the command after the call. The calls of
+    the functions named in `builtins` run their vm_builtins version instead,
+    except those of the classes in `disabled_classes`, whose statics don't match
+    what the builtins expect.
+    """
+
+    def __init__(self, vm_files: list[str], builtins: Iterable[str] = ()):
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        # code and operands of every command
+        self.__codes = array("B")
+        self.__args = array("l")
+        self.__indexes = array("l")
+        # the command each code was loaded from, for vm_profiler
+        self.instructions: list[Instruction] = []
+        self.functions: dict[str, int] = {}
+        self.__statics: dict[str, int] = {}
+        # functions that pop each static, by file and index
+        self.__static_writers: dict[str, dict[int, set[str]]] = {}
+        self.disabled_classes: set[str] = set()
+        # builtin and index of the function it replaces, by NATIVE operand
+        self.__natives: list[tuple[Callable[..., int], int]] = []
+        self.system = OperatingSystem(self.ram, self.static_address)
+        self.__load(vm_files, set(builtins))
+        self.reset()
+
+    def reset(self):
+        self.pc = self.functions.get("Sys.init", 0)
+        self.steps = 0
+        self.halted = False
+
+    def stop_at(self, function_name: str):
+        """
+        Halt when the function is entered, e.g. Sys.halt which loops forever.
+        """
+        if function_name in self.functions:
+            self.__codes[self.functions[function_name]] = HALT
+
+    def __load(self, vm_files: list[str], builtins: set[str]):
+        calls: list[tuple[int, str]] = []
+        for vm_file in vm_files:
+            filename = os.path.splitext(os.path.basename(vm_file))[0]
+            self.__static_writers.setdefault(filename, {})
+            with open(vm_file, "r") as input_file:
+                for function in split_functions(vm_ir.parse(input_file)):
+                    calls.extend(self.__load_function(filename, function))
+        for idx, function_name in calls:
+            if function_name not in self.functions:
+                raise NotImplementedError(f"Unknown function {function_name}")
+            self.__args[idx] = self.functions[function_name]
+        self.disabled_classes = incompatible_classes(self.__static_writers) & {
+            function_name.split(".")[0] for function_name in builtins
+        }
+        natives: dict[str, int] = {}
+        for idx, function_name in calls:
+            if (
+                function_name not in builtins
+                or function_name.split(".")[0] in self.disabled_classes
+            ):
+                continue
+            if function_name not in natives:
+                natives[function_name] = len(self.__natives)
+                self.__natives.append(
+                    (BUILTINS[function_name], self.functions[function_name])
+                )
+            self.__codes[idx] = NATIVE
+            self.__args[idx] = natives[function_name]
+        # running past the last command halts
+        self.__emit(HALT)
+        assert len(self.__codes) <= 0xFFFF, "return addresses must fit in a word"
+
+    def __load_function(
+        self, filename: str, function: list[Instruction]
+    ) -> list[tuple[int, str]]:
+        """
+        :return: the calls of the function, resolved once every file is loaded
+        """
+        labels: dict[str, int] = {}
+        jumps: list[tuple[int, str]] = []
+        calls: list[tuple[int, str]] = []
+        statics = self.__static_writers[filename]
+        # the commands before the first function belong to none
+        name = function[0].arg if function[0].op == Op.FUNCTION else None
+        for instruction in function:
+            op: Op = instruction.op
+            if instruction.arg == Segment.STATIC:
+                writers = statics.setdefault(instruction.index, set())
+                if op == Op.POP:
+                    writers.add(name)
+            if op == Op.FUNCTION:
+                self.functions[instruction.arg] = len(self.__codes)
+            elif op == Op.LABEL:
+                labels[instruction.arg] = len(self.__codes)
+            elif op == Op.GOTO or op == Op.IF_GOTO:
+                jumps.append((len(self.__codes), instruction.arg))
+            elif op == Op.CALL:
+                calls.append((len(self.__codes), instruction.arg))
+            self.__append(filename, instruction)
+        # labels are scoped by function, so jumps are resolved with its labels
+        for idx, label in jumps:
+            if label not in labels:
+                raise NotImplementedError(f"Unknown label {label}")
+            self.__args[idx] = labels[label]
+        return calls
+
+    def __emit(self, code: int, arg: int = 0, index: int = 0):
+        self.__codes.append(code)
+        self.__args.append(arg)
+        self.__indexes.append(index)
+
+    def __append(self, filename: str, instruction: Instruction):
+        op: Op = instruction.op
+        if op != Op.LABEL:
+            self.instructions.append(instruction)
+        if op == Op.PUSH and instruction.arg == Segment.CONSTANT:
+            self.__emit(PUSH_CONSTANT, instruction.index & 0xFFFF)
+        elif (op == Op.PUSH or op == Op.POP) and instruction.arg in BASES:
+            code = PUSH_BASED if op == Op.PUSH else POP_BASED
+            self.__emit(code, BASES[instruction.arg], instruction.index)
+        elif op == Op.PUSH or op == Op.POP:
+            code = PUSH_FIXED if op == Op.PUSH else POP_FIXED
+            self.__emit(code, self.__address(filename, instruction))
+        elif op in ARITHMETIC:
+            self.__emit(ARITHMETIC[op])
+        elif op == Op.LABEL:
+            pass
+        elif op == Op.GOTO:
+            self.__emit(GOTO)
+        elif op == Op.IF_GOTO:
+            self.__emit(IF_GOTO)
+        elif op == Op.FUNCTION:
+            self.__emit(FUNCTION, 0, instruction.index)
+        elif op == Op.CALL:
+            self.__emit(CALL, 0, instruction.index)
+        elif op == Op.RETURN:
+            self.__emit(RETURN)
+        else:
+            raise NotImplementedError(f"Unsupported command {instruction}")
+
+    def __address(self, filename: str, instruction: Instruction) -> int:
+        segment, index = instruction.arg, instruction.index
+        if segment == Segment.TEMP:
+            return 5 + index
+        if segment == Segment.POINTER:
+            return 3 + index
+        if segment == Segment.STATIC:
+            return self.static_address(f"{filename}.{index}")
+        raise NotImplementedError(f"Unknown segment {segment.name.lower()}")
+
+    def static_address(self, symbol: str) -> int:
+        """
+        :param symbol: a static as `File.index`, allocated from 16 in order of
+            first use like assembler variables
+        """
+        if symbol not in self.__statics:
+            self.__statics[symbol] = 16 + len(self.__statics)
+        return self.__statics[symbol]
+
+    def run(self, max_steps: int) -> int:
+        """
+        Execute until `max_steps` commands have run or the program halts, by
+        entering a function of `stop_at`, running past its last command or
+        returning to an address that isn't one.
+        :return: number of executed commands
+        """
+        codes, args, indexes, ram = self.__codes, self.__args, self.__indexes, self.ram
+        natives, system = self.__natives, self.system
+        size = len(codes)
+        pc = self.pc
+        # SP is kept in a local and stored back to RAM[0] when the run ends
+        sp = ram[0]
+        steps = 0
+        try:
+            # ordered by how often Pong with the OS runs each command
+            while steps < max_steps:
+                code = codes[pc]
+                steps += 1
+                if code == PUSH_BASED:
+                    ram[sp] = ram[(ram[args[pc]] + indexes[pc]) & 0x7FFF]
+                    sp += 1
+                    pc += 1
+                elif code == PUSH_CONSTANT:
+                    ram[sp] = args[pc]
+                    sp += 1
+                    pc += 1
+                elif code == ADD:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+                    pc += 1
+                elif code == NOT:
+                    ram[sp - 1] ^= 0xFFFF
+                    pc += 1
+                elif code == IF_GOTO:
+                    sp -= 1
+                    pc = args[pc] if ram[sp] else pc + 1
+                elif code == POP_BASED:
+                    sp -= 1
+                    ram[(ram[args[pc]] + indexes[pc]) & 0x7FFF] = ram[sp]
+                    pc += 1
+                elif code == POP_FIXED:
+                    sp -= 1
+                    ram[args[pc]] = ram[sp]
+                    pc += 1
+                elif code == PUSH_FIXED:
+                    ram[sp] = ram[args[pc]]
+                    sp += 1
+                    pc += 1
+                elif code == GOTO:
+                    pc = args[pc]
+                elif code == LT or code == EQ or code == GT:
+                    sp -= 1
+                    # flipping the sign bit orders words like signed values
+                    x, y = ram[sp - 1] ^ 0x8000, ram[sp] ^ 0x8000
+                    if code == LT:
+                        result = x < y
+                    elif code == EQ:
+                        result = x == y
+                    else:
+                        result = x > y
+                    ram[sp - 1] = 0xFFFF if result else 0
+                    pc += 1
+                elif code == FUNCTION:
+                    for idx in range(sp, sp + indexes[pc]):
+                        ram[idx] = 0
+                    sp += indexes[pc]
+                    pc += 1
+                elif code == CALL or code == NATIVE:
+                    target = args[pc]
+                    if code == NATIVE:
+                        function, target = natives[target]
+                        result = system.call(function, ram[sp - indexes[pc] : sp])
+                        if result is not None:
+                            sp -= indexes[pc]
+                            ram[sp] = result
+                            sp += 1
+                            pc += 1
+                            continue
+                    ram[sp] = pc + 1
+                    ram[sp + 1] = ram[1]
+                    ram[sp + 2] = ram[2]
+                    ram[sp + 3] = ram[3]
+                    ram[sp + 4] = ram[4]
+                    sp += 5
+                    ram[2] = sp - 5 - indexes[pc]
+                    ram[1] = sp
+                    pc = target
+                elif code == RETURN:
+                    frame = ram[1]
+                    return_address = ram[frame - 5]
+                    arg = ram[2]
+                    ram[arg] = ram[sp - 1]
+                    sp = arg + 1
+                    ram[4] = ram[frame - 1]
+                    ram[3] = ram[frame - 2]
+                    ram[2] = ram[frame - 3]
+                    ram[1] = ram[frame - 4]
+                    pc = return_address
+                    if pc >= size:
+                        self.halted = True
+                        break
+                elif code == AND:
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                    pc += 1
+                elif code == NEG:
+                    ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+                    pc += 1
+                elif code == SUB:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+                    pc += 1
+                elif code == OR:
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+                    pc += 1
+                else:  # HALT
+                    steps -= 1
+                    self.halted = True
+                    break
+        except IndexError:
+            # only the stack is addressed without wrapping around the RAM
+            raise OverflowError(f"Stack overflow after {self.steps + steps} commands")
+        ram[0] = sp
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+
+def load_program(
+    vm_files: list[str], stop_functions: list[str], builtins: Iterable[str] = ()
+) -> VMInterpreter:
+    """
+    Load a compiled Jack program to run from Sys.init until it enters one of
+    `stop_functions`, with the stack where the bootstrap code puts it.
+    """
+    interpreter = VMInterpreter(vm_files, builtins)
+    for function_name in stop_functions:
+        interpreter.stop_at(function_name)
+    interpreter.ram[POINTERS["sp"]] = 256
+    return interpreter
+
+
+def run_program(
+    vm_files: list[str],
+    stop_functions: list[str],
+    max_steps: int,
+    builtins: Iterable[str] = (),
+) -> VMInterpreter:
+    interpreter = load_program(vm_files, stop_functions, builtins)
+    interpreter.run(max_steps)
+    return interpreter
+
+
+def read_cmp(filepath: str) -> dict[int, int]:
+    """
+    :return: the RAM values of a .cmp file, by address
+    """
+    expected: dict[int, int] = {}
+    with open(filepath, "r") as cmp_file:
+        rows = [line.strip().strip("|").split("|") for line in cmp_file if line.strip()]
+    for header, values in zip(rows[::2], rows[1::2]):
+        for name, value in zip(header, values):
+            # headers wider than their column lose the closing bracket
+            address = int(re.search(r"RAM\[(\d+)", name).group(1))
+            expected[address] = int(value)
+    return expected
+
+
+def run_vme_test(filepath: str) -> tuple[int, list[tuple[int, int, int]]]:
+    """
+    Run a VM emulator script: its `set` commands, then `repeat n { vmstep; }`.
+
+    :return: the executed commands and the (address, actual, expected) RAM values
+        that don't match its .cmp file
+    """
+    directory = os.path.dirname(filepath)
+    with open(filepath, "r") as tst_file:
+        script = re.sub(r"//.*", "", tst_file.read())
+    interpreter = VMInterpreter(sorted(glob.glob(os.path.join(directory, "*.vm"))))
+    ram = interpreter.ram
+    for target, offset, value in re.findall(
+        r"set\s+(\w+)(?:\[(\d+)\])?\s+(-?\d+)", script
+    ):
+        if target == "RAM":
+            ram[int(offset)] = int(value) & 0xFFFF
+        elif offset:
+            ram[ram[POINTERS[target]] + int(offset)] = int(value) & 0xFFFF
+        else:
+            ram[POINTERS[target]] = int(value) & 0xFFFF
+    interpreter.run(int(re.search(r"repeat\s+(\d+)", script).group(1)))
+    compare_to = re.search(r"compare-to\s+([\w.]+)", script).group(1)
+    mismatches = [
+        (address, to_signed(ram[address]), value)
+        for address, value in read_cmp(os.path.join(directory, compare_to)).items()
+        if to_signed(ram[address]) != value
+    ]
+    return interpreter.steps, mismatches
+
+
+def to_signed(value: int) -> int:
+    return value - 0x10000 if value & 0x8000 else value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VM Interpreter")
+    parser.add_argument(
+        "vm",
+        nargs="?",
+        help="a .vm file, a directory of them or a VM emulator .tst script",
+    )
+    parser.add_argument(
+        "--tests",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="run every VM emulator script of projects/07 and projects/08",
+    )
+    parser.add_argument(
+        "--steps", type=int, default=100_000_000, help="maximum commands to run"
+    )
+    parser.add_argument(
+        "--stop",
+        action="append",
+        default=["Sys.halt"],
+        help="function to halt on entering, Sys.halt by default",
+    )
+    parser.add_argument(
+        "--builtins",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="run the OS functions of vm_builtins in Python",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="OS function to run as VM code even with --builtins",
+    )
+    parser.add_argument(
+        "--compare",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="also run without builtins and compare the statics, heap and screen",
+    )
+    args = parser.parse_args()
+
+    tests = VME_TESTS if args.tests else []
+    if args.vm and args.vm.endswith(".tst"):
+        tests = [os.path.abspath(args.vm)]
+    if tests:
+        failures = 0
+        for filepath in tests:
+            start = time.perf_counter()
+            steps, mismatches = run_vme_test(filepath)
+            elapsed = time.perf_counter() - start
+            name = os.path.basename(filepath)[: -len("VME.tst")]
+            print(f"{name:<20}{steps:>8} steps{elapsed * 1000:>8.1f} ms")
+            for address, actual, value in mismatches:
+                print(f"  FAIL: RAM[{address}] is {actual}, expected {value}")
+                failures += 1
+        sys.exit(1 if failures else 0)
+
+    assert args.vm, "A .vm file, a directory or --tests is required"
+    input_path: str = os.path.abspath(args.vm)
+    vm_files: list[str] = (
+        sorted(glob.glob(f"{input_path}/*.vm"))
+        if os.path.isdir(input_path)
+        else [input_path]
+    )
+    assert len(vm_files) > 0, f"No *.vm file is found from {input_path}"
+    for function_name in args.exclude:
+        assert function_name in BUILTINS, f"No builtin {function_name}"
+    builtins = set(BUILTINS) - set(args.exclude) if args.builtins else set()
+    start = time.perf_counter()
+    interpreter = run_program(vm_files, args.stop, args.steps, builtins)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Ran {interpreter.steps} commands in {elapsed:.2f}s, "
+        + ("halted" if interpreter.halted else "stopped")
+        + f" with SP={interpreter.ram[0]}"
+    )
+    if interpreter.disabled_classes:
+        print(
+            "No builtins for "
+            + ", ".join(sorted(interpreter.disabled_classes))
+            + ", whose statics differ from the projects/12 OS"
+        )
+    if builtins:
+        print(
+            f"{interpreter.system.calls} builtin calls, "
+            f"{interpreter.system.fallbacks} left to the VM code"
+        )
+    if args.compare:
+        start = time.perf_counter()
+        reference = run_program(vm_files, args.stop, args.steps)
+        elapsed = time.perf_counter() - start
+        differences = sum(
+            x != y
+            for x, y in zip(
+                interpreter.ram[16:256] + interpreter.ram[2048:KBD],
+                reference.ram[16:256] + reference.ram[2048:KBD],
+            )
+        )
+        print(
+            f"Without builtins: {reference.steps} commands in {elapsed:.2f}s, "
+            f"{differences} words of statics, heap and screen differ"
+        )
+        sys.exit(1 if differences else 0)
@@ -0,0 +1,174 @@
+from enum import IntEnum
+from typing import Iterable, Iterator, Optional, Union
+
+
+class Op(IntEnum):
+    PUSH = 0
+    POP = 1
+    ADD = 2
+    SUB = 3
+    NEG = 4
+    EQ = 5
+    GT = 6
+    LT = 7
+    AND = 8
+    OR = 9
+    NOT = 10
+    LABEL = 11
+    GOTO = 12
+    IF_GOTO = 13
+    # jumps if the popped value is 0, only produced by the optimizer
+    IF_NOT_GOTO = 14
+    FUNCTION = 15
+    CALL = 16
+    RETURN = 17
+    # superinstructions produced by vm_optimizer.fuse
+    IF_EQ_GOTO = 18
+    IF_NE_GOTO = 19
+    IF_GT_GOTO = 20
+    IF_LE_GOTO = 21
+    IF_LT_GOTO = 22
+    IF_GE_GOTO = 23
+    ADD_CONSTANT = 24
+    SUB_CONSTANT = 25
+    LOAD_INDEXED = 26
+
+
+class Segment(IntEnum):
+    ARGUMENT = 0
+    LOCAL = 1
+    STATIC = 2
+    CONSTANT = 3
+    THIS = 4
+    THAT = 5
+    POINTER = 6
+    TEMP = 7
+
+
+COMMANDS = {
+    "push": Op.PUSH,
+    "pop": Op.POP,
+    "add": Op.ADD,
+    "sub": Op.SUB,
+    "neg": Op.NEG,
+    "eq": Op.EQ,
+    "gt": Op.GT,
+    "lt": Op.LT,
+    "and": Op.AND,
+    "or": Op.OR,
+    "not": Op.NOT,
+    "label": Op.LABEL,
+    "goto": Op.GOTO,
+    "if-goto": Op.IF_GOTO,
+    "function": Op.FUNCTION,
+    "call": Op.CALL,
+    "return": Op.RETURN,
+}
+# commands only built by vm_optimizer, named for printing but never parsed
+INTERNAL_COMMANDS = {
+    "if-not-goto": Op.IF_NOT_GOTO,
+    "if-eq-goto": Op.IF_EQ_GOTO,
+    "if-ne-goto": Op.IF_NE_GOTO,
+    "if-gt-goto": Op.IF_GT_GOTO,
+    "if-le-goto": Op.IF_LE_GOTO,
+    "if-lt-goto": Op.IF_LT_GOTO,
+    "if-ge-goto": Op.IF_GE_GOTO,
+    "add-constant": Op.ADD_CONSTANT,
+    "sub-constant": Op.SUB_CONSTANT,
+    "load-indexed": Op.LOAD_INDEXED,
+}
+NAMES = {op: command for command, op in {**COMMANDS, **INTERNAL_COMMANDS}.items()}
+SEGMENTS = {segment.name.lower(): segment for segment in Segment}
+ARITHMETIC = {Op.ADD, Op.SUB, Op.NEG, Op.EQ, Op.GT, Op.LT, Op.AND, Op.OR, Op.NOT}
+# comparison-and-branch superinstructions and their Hack jump
+COMPARE_BRANCHES = {
+    Op.IF_EQ_GOTO: "JEQ",
+    Op.IF_NE_GOTO: "JNE",
+    Op.IF_GT_GOTO: "JGT",
+    Op.IF_LE_GOTO: "JLE",
+    Op.IF_LT_GOTO: "JLT",
+    Op.IF_GE_GOTO: "JGE",
+}
+BRANCHES = {Op.LABEL, Op.GOTO, Op.IF_GOTO, Op.IF_NOT_GOTO, *COMPARE_BRANCHES}
+SEGMENT_OPERATIONS = {Op.PUSH, Op.POP, Op.LOAD_INDEXED}
+
+
+class Instruction:
+    """
+    A VM command. `arg` is the segment of push/pop, the label of branches and the
+    function name of function/call; `index` is the segment index, the number of
+    local variables of function, the number of arguments of call and the operand
+    of add-constant/sub-constant. `line` is the line of the VM file it was
+    parsed from, 0 for commands generated by the optimizer, and isn't compared
+    or hashed.
+    """
+
+    __slots__ = ("op", "arg", "index", "line")
+
+    def __init__(
+        self,
+        op: Op,
+        arg: Union[Segment, str, None] = None,
+        index: int = 0,
+        line: int = 0,
+    ):
+        self.op = op
+        self.arg = arg
+        self.index = index
+        self.line = line
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, Instruction)
+            and self.op == other.op
+            and self.arg == other.arg
+            and self.index == other.index
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.op, self.arg, self.index))
+
+    def __repr__(self) -> str:
+        return f"Instruction({self})"
+
+    def __str__(self) -> str:
+        if self.op in SEGMENT_OPERATIONS:
+            return f"{NAMES[self.op]} {self.arg.name.lower()} {self.index}"
+        if self.op == Op.FUNCTION or self.op == Op.CALL:
+            return f"{NAMES[self.op]} {self.arg} {self.index}"
+        if self.op in BRANCHES:
+            return f"{NAMES[self.op]} {self.arg}"
+        if self.op == Op.ADD_CONSTANT or self.op == Op.SUB_CONSTANT:
+            return f"{NAMES[self.op]} {self.index}"
+        return NAMES[self.op]
+
+
+def parse_line(line: str) -> Optional[Instruction]:
+    """
+    :return: the instruction of a line, None for blank and comment lines; only
+        the commands of the VM language are accepted, not the internal ones
+    """
+    tokens: list[str] = line.split("//", 1)[0].split()
+    if not tokens:
+        return None
+    op: Optional[Op] = COMMANDS.get(tokens[0])
+    if op is None:
+        raise NotImplementedError(f"Unknown command {tokens[0]}")
+    if op in SEGMENT_OPERATIONS:
+        segment: Optional[Segment] = SEGMENTS.get(tokens[1])
+        if segment is None:
+            raise NotImplementedError(f"Unknown segment {tokens[1]}")
+        return Instruction(op, segment, int(tokens[2]))
+    if op == Op.FUNCTION or op == Op.CALL:
+        return Instruction(op, tokens[1], int(tokens[2]))
+    if op in BRANCHES:
+        return Instruction(op, tokens[1])
+    return Instruction(op)
+
+
+def parse(lines: Iterable[str]) -> Iterator[Instruction]:
+    for number, line in enumerate(lines, 1):
+        instruction = parse_line(line)
+        if instruction is not None:
+            instruction.line = number
+            yield instruction
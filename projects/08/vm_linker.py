@@ -0,0 +1,376 @@
+import argparse
+import glob
+import os
+from collections import Counter
+from typing import Iterable, Optional
+
+import vm_optimizer
+from vm_ir import COMPARE_BRANCHES, SEGMENT_OPERATIONS, Instruction, Op, Segment, parse
+
+# change of the stack depth by the commands that don't depend on their operand
+STACK_EFFECTS = {
+    Op.PUSH: 1,
+    Op.POP: -1,
+    Op.ADD: -1,
+    Op.SUB: -1,
+    Op.NEG: 0,
+    Op.EQ: -1,
+    Op.GT: -1,
+    Op.LT: -1,
+    Op.AND: -1,
+    Op.OR: -1,
+    Op.NOT: 0,
+    Op.LABEL: 0,
+    Op.GOTO: 0,
+    Op.IF_GOTO: -1,
+    Op.IF_NOT_GOTO: -1,
+    Op.ADD_CONSTANT: 0,
+    Op.SUB_CONSTANT: 0,
+    Op.LOAD_INDEXED: 0,
+    **{op: -2 for op in COMPARE_BRANCHES},
+}
+JUMPS = {Op.GOTO, Op.IF_GOTO, Op.IF_NOT_GOTO, *COMPARE_BRANCHES}
+MAX_INLINE_GROWTH = 256
+# where the stack starts, it grows up to the static frames
+STACK_BASE = 256
+# words of stack the static frames must leave by default
+MIN_STACK = 1024
+
+
+def scan(vm_files: list[str]) -> tuple[dict[str, set[str]], dict[str, int]]:
+    """
+    Read the VM files once, keeping only function names and calls.
+    :return: the functions called by every function, and its number of commands
+    """
+    calls: dict[str, set[str]] = {}
+    sizes: dict[str, int] = {}
+    for vm_file in vm_files:
+        function_name = None
+        with open(vm_file, "r") as input_file:
+            for instruction in parse(input_file):
+                if instruction.op == Op.FUNCTION:
+                    function_name = instruction.arg
+                    calls.setdefault(function_name, set())
+                    sizes[function_name] = 0
+                elif instruction.op == Op.CALL and function_name is not None:
+                    calls[function_name].add(instruction.arg)
+                if function_name is not None:
+                    sizes[function_name] += 1
+    return calls, sizes
+
+
+def reachable(calls: dict[str, set[str]], root: str = "Sys.init") -> set[str]:
+    """
+    :return: the functions reachable from `root` in the call graph, including it
+    """
+    visited = {root}
+    stack = [root]
+    while stack:
+        for callee in calls.get(stack.pop(), ()):
+            if callee not in visited:
+                visited.add(callee)
+                stack.append(callee)
+    return visited
+
+
+def report(calls: dict[str, set[str]], sizes: dict[str, int], kept: set[str]) -> str:
+    removed = sorted(set(calls) - kept)
+    lines = [
+        f"Removed {len(removed)} of {len(calls)} functions, "
+        f"{sum(sizes[name] for name in removed)} of {sum(sizes.values())} VM commands"
+    ]
+    lines.extend(f"  {name} ({sizes[name]})" for name in removed)
+    return "\n".join(lines)
+
+
+def strongly_connected_components(calls: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Tarjan's algorithm, with an explicit stack instead of recursion.
+    :return: the components of the call graph, every one after the ones it calls
+    """
+    index: dict[str, int] = {}
+    low: dict[str, int] = {}
+    stack: list[str] = []
+    on_stack: set[str] = set()
+    components: list[list[str]] = []
+    for root in calls:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(calls[root]))]
+        while work:
+            node, callees = work[-1]
+            for callee in callees:
+                if callee not in calls:
+                    # never defined, it can't call back
+                    continue
+                if callee not in index:
+                    index[callee] = low[callee] = len(index)
+                    stack.append(callee)
+                    on_stack.add(callee)
+                    work.append((callee, iter(calls[callee])))
+                    break
+                if callee in on_stack:
+                    low[node] = min(low[node], index[callee])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component: list[str] = []
+                    while not component or component[-1] != node:
+                        component.append(stack.pop())
+                        on_stack.discard(component[-1])
+                    components.append(component)
+    return components
+
+
+def recursive_functions(calls: dict[str, set[str]]) -> set[str]:
+    """
+    :return: the functions that can call themselves, directly or not
+    """
+    return {
+        name
+        for component in strongly_connected_components(calls)
+        for name in component
+        if len(component) > 1 or name in calls[name]
+    }
+
+
+def is_balanced(function: list[Instruction]) -> bool:
+    """
+    Follow the stack depth through the branches of a function.
+    :return: whether it never pops below its start and returns with only the
+        return value on the stack
+    """
+    depths: dict[str, int] = {}
+    depth: Optional[int] = 0
+    for instruction in function[1:]:
+        op: Op = instruction.op
+        if op == Op.LABEL:
+            if depth is None:
+                # only reachable by a jump, which must have been seen before
+                depth = depths.get(instruction.arg)
+                if depth is None:
+                    return False
+            elif depths.setdefault(instruction.arg, depth) != depth:
+                return False
+            continue
+        if depth is None:
+            continue
+        if op == Op.RETURN:
+            if depth != 1:
+                return False
+            depth = None
+            continue
+        if op == Op.CALL:
+            depth += 1 - instruction.index
+        elif op in STACK_EFFECTS:
+            depth += STACK_EFFECTS[op]
+        else:
+            return False
+        if depth < 0:
+            return False
+        if op in JUMPS and depths.setdefault(instruction.arg, depth) != depth:
+            return False
+        if op == Op.GOTO:
+            depth = None
+    return True
+
+
+class Frame:
+    """
+    The fixed RAM of a function that is never active twice at the same time: its
+    return address, the THIS and THAT of its caller, then its arguments and its
+    local variables.
+    """
+
+    __slots__ = ("address", "n_args", "n_vars", "saves_this", "saves_that")
+
+    def __init__(
+        self, address: int, n_args: int, n_vars: int, saves_this: bool, saves_that: bool
+    ):
+        self.address = address
+        self.n_args = n_args
+        self.n_vars = n_vars
+        # whether the function sets pointer 0 or 1, so restores it on return
+        self.saves_this = saves_this
+        self.saves_that = saves_that
+
+    def __len__(self) -> int:
+        return 3 + self.n_args + self.n_vars
+
+    def argument(self, index: int) -> int:
+        return self.address + 3 + index
+
+    def local(self, index: int) -> int:
+        return self.address + 3 + self.n_args + index
+
+
+def read_functions(vm_files: Iterable[str]) -> dict[str, list[Instruction]]:
+    functions: dict[str, list[Instruction]] = {}
+    function: Optional[list[Instruction]] = None
+    for vm_file in vm_files:
+        with open(vm_file, "r") as input_file:
+            for instruction in parse(input_file):
+                if instruction.op == Op.FUNCTION:
+                    function = functions[instruction.arg] = []
+                if function is not None:
+                    function.append(instruction)
+    return functions
+
+
+def leaf_functions(
+    vm_files: list[str], max_size: int, max_growth: int = MAX_INLINE_GROWTH
+) -> dict[str, tuple[str, list[Instruction]]]:
+    """
+    :param max_growth: maximum number of VM commands that inlining a function at
+        all its call sites may add, so that e.g. String.appendChar, which string
+        constants call for every character, stays a call
+    :return: the functions of at most `max_size` commands that call no other and
+        keep their stack balanced, with the name of their file
+    """
+    files: dict[str, str] = {}
+    functions: dict[str, list[Instruction]] = {}
+    for vm_file in vm_files:
+        filename = os.path.splitext(os.path.basename(vm_file))[0]
+        for name, function in read_functions([vm_file]).items():
+            files[name] = filename
+            functions[name] = function
+    growth: Counter = Counter()
+    for function in functions.values():
+        for instruction in function:
+            callee = functions.get(instruction.arg)
+            if instruction.op == Op.CALL and callee is not None:
+                code, _ = vm_optimizer.inline_call(callee, instruction.index, 0, "")
+                growth[instruction.arg] += len(code) - 1
+    return {
+        name: (files[name], function)
+        for name, function in functions.items()
+        if len(function) - 1 <= max_size
+        and growth[name] <= max_growth
+        and all(instruction.op != Op.CALL for instruction in function)
+        and is_balanced(function)
+    }
+
+
+def inline_bodies(
+    leaves: dict[str, tuple[str, list[Instruction]]], filename: str
+) -> dict[str, list[Instruction]]:
+    """
+    :return: the leaves that can be inlined in a file: statics are named after
+        their file, so functions using them are only inlined in their own
+    """
+    return {
+        name: function
+        for name, (leaf_filename, function) in leaves.items()
+        if leaf_filename == filename
+        or all(
+            instruction.op not in SEGMENT_OPERATIONS
+            or instruction.arg != Segment.STATIC
+            for instruction in function
+        )
+    }
+
+
+def allocate_frames(
+    vm_files: list[str],
+    end: int = 2048,
+    leaves: Optional[dict[str, tuple[str, list[Instruction]]]] = None,
+    min_stack: int = MIN_STACK,
+) -> dict[str, Frame]:
+    """
+    Give static frames to the functions that aren't recursive, are called with
+    the same number of arguments everywhere and keep their stack balanced. Frames
+    are placed below `end`, where the stack would end, and only overlap when
+    their functions are never on the same call path. With `leaves`, functions are
+    analysed once inlined like the translator does. Nothing stops the stack from
+    growing into the frames, so they must leave it at least `min_stack` words.
+    """
+    functions: dict[str, list[Instruction]] = {}
+    for vm_file in vm_files:
+        file_functions = read_functions([vm_file])
+        if leaves:
+            bodies = inline_bodies(
+                leaves, os.path.splitext(os.path.basename(vm_file))[0]
+            )
+            for name, function in file_functions.items():
+                inlined = vm_optimizer.inline(function, bodies, Counter())
+                file_functions[name] = list(inlined)
+        functions.update(file_functions)
+    calls: dict[str, set[str]] = {name: set() for name in functions}
+    n_args: dict[str, set[int]] = {}
+    for name, function in functions.items():
+        for instruction in function:
+            if instruction.op == Op.CALL:
+                calls[name].add(instruction.arg)
+                n_args.setdefault(instruction.arg, set()).add(instruction.index)
+    recursive = recursive_functions(calls)
+    frames: dict[str, Frame] = {}
+    for name, function in functions.items():
+        if name in recursive or len(n_args.get(name, ())) != 1:
+            continue
+        (count,) = n_args[name]
+        if vm_optimizer.arguments_used(function) > count or not is_balanced(function):
+            continue
+        pointers = vm_optimizer.writes_pointers(function)
+        frames[name] = Frame(0, count, function[0].index, 0 in pointers, 1 in pointers)
+    # callers come first, a callee starts after the end of all its callers
+    starts: dict[str, int] = {name: 0 for name in functions}
+    for component in reversed(strongly_connected_components(calls)):
+        start = max(starts[name] for name in component)
+        component_end = start + sum(
+            len(frames[name]) for name in component if name in frames
+        )
+        for name in component:
+            starts[name] = start
+            for callee in calls[name]:
+                if callee in starts and callee not in component:
+                    starts[callee] = max(starts[callee], component_end)
+    size = max((starts[name] + len(frame) for name, frame in frames.items()), default=0)
+    if end - size - STACK_BASE < min_stack:
+        raise OverflowError(
+            f"Static frames of {size} words leave {end - size - STACK_BASE} words "
+            f"of stack, less than {min_stack}"
+        )
+    for name, frame in frames.items():
+        frame.address = end - size + starts[name]
+    return frames
+
+
+def frame_report(calls: dict[str, set[str]], frames: dict[str, Frame]) -> str:
+    low = min((frame.address for frame in frames.values()), default=0)
+    high = max((frame.address + len(frame) for frame in frames.values()), default=0)
+    lines = [
+        f"Static frames for {len(frames)} of {len(calls)} functions in "
+        f"{high - low} words from RAM[{low}]"
+    ]
+    if frames:
+        lines.append(
+            f"Stack limited to RAM[{STACK_BASE}:{low}], {low - STACK_BASE} words"
+        )
+    lines.extend(f"  {name} (recursive)" for name in sorted(recursive_functions(calls)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the functions that are never called from Sys.init "
+        "and the ones that get static frames"
+    )
+    parser.add_argument("vm", help="directory of VM code")
+    parser.add_argument(
+        "--min-stack",
+        type=int,
+        default=MIN_STACK,
+        help="words of stack the static frames must leave",
+    )
+    args = parser.parse_args()
+
+    vm_files = sorted(glob.glob(f"{os.path.abspath(args.vm)}/*.vm"))
+    calls, sizes = scan(vm_files)
+    print(report(calls, sizes, reachable(calls)))
+    print(frame_report(calls, allocate_frames(vm_files, min_stack=args.min_stack)))
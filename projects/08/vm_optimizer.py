@@ -0,0 +1,313 @@
+from collections import Counter
+from typing import Callable, Iterable, Iterator
+
+from vm_ir import BRANCHES, NAMES, SEGMENT_OPERATIONS, Instruction, Op, Segment
+
+COMPARISONS = {Op.EQ, Op.GT, Op.LT}
+FOLDABLE: dict[Op, Callable[[int, int], int]] = {
+    Op.ADD: lambda x, y: x + y,
+    Op.SUB: lambda x, y: x - y,
+    Op.AND: lambda x, y: x & y,
+    Op.OR: lambda x, y: x | y,
+    Op.EQ: lambda x, y: -(x == y),
+    Op.GT: lambda x, y: -(x > y),
+    Op.LT: lambda x, y: -(x < y),
+}
+# comparison -> superinstructions jumping when it holds and when it doesn't
+BRANCH_FUSIONS = {
+    Op.EQ: (Op.IF_EQ_GOTO, Op.IF_NE_GOTO),
+    Op.GT: (Op.IF_GT_GOTO, Op.IF_LE_GOTO),
+    Op.LT: (Op.IF_LT_GOTO, Op.IF_GE_GOTO),
+}
+
+
+def is_constant(instruction: Instruction) -> bool:
+    return instruction.op == Op.PUSH and instruction.arg == Segment.CONSTANT
+
+
+def fold_constants(instructions: list[Instruction]) -> list[Instruction]:
+    """
+    Replace `push constant x; push constant y; op` by the result when it can be
+    pushed as a constant, i.e. when it is between 0 and 32767.
+    """
+    results: list[Instruction] = []
+    for instruction in instructions:
+        if (
+            instruction.op in FOLDABLE
+            and len(results) >= 2
+            and is_constant(results[-1])
+            and is_constant(results[-2])
+        ):
+            value = FOLDABLE[instruction.op](results[-2].index, results[-1].index)
+            if 0 <= value <= 0x7FFF:
+                line = results[-2].line
+                del results[-2:]
+                results.append(Instruction(Op.PUSH, Segment.CONSTANT, value, line))
+                continue
+        results.append(instruction)
+    return results
+
+
+def eliminate_push_pop(instructions: list[Instruction]) -> list[Instruction]:
+    """
+    Drop `push X; pop X`, which stores a value where it already is.
+    """
+    results: list[Instruction] = []
+    for instruction in instructions:
+        if (
+            instruction.op == Op.POP
+            and results
+            and results[-1].op == Op.PUSH
+            and results[-1].arg == instruction.arg
+            and results[-1].index == instruction.index
+        ):
+            results.pop()
+            continue
+        results.append(instruction)
+    return results
+
+
+def invert_branches(instructions: list[Instruction]) -> list[Instruction]:
+    """
+    Drop `not; not`, and turn `not; if-goto` into a jump on 0 when the negated
+    value is a comparison result: `not` is bitwise, so this is only the same
+    branch for 0 and -1.
+    """
+    results: list[Instruction] = []
+    for instruction in instructions:
+        if instruction.op == Op.NOT and results and results[-1].op == Op.NOT:
+            results.pop()
+            continue
+        if (
+            instruction.op == Op.IF_GOTO
+            and len(results) >= 2
+            and results[-1].op == Op.NOT
+            and results[-2].op in COMPARISONS
+        ):
+            results[-1] = Instruction(
+                Op.IF_NOT_GOTO, instruction.arg, line=results[-1].line
+            )
+            continue
+        results.append(instruction)
+    return results
+
+
+def remove_unreachable(instructions: list[Instruction]) -> list[Instruction]:
+    """
+    Drop the commands between goto/return and the next label, and a goto to a
+    label that directly follows it.
+    """
+    results: list[Instruction] = []
+    reachable = True
+    for instruction in instructions:
+        if instruction.op == Op.LABEL or instruction.op == Op.FUNCTION:
+            reachable = True
+        elif not reachable:
+            continue
+        elif instruction.op == Op.GOTO or instruction.op == Op.RETURN:
+            reachable = False
+        results.append(instruction)
+    idx = len(results) - 1
+    while idx >= 0:
+        if results[idx].op == Op.GOTO:
+            end = idx + 1
+            while end < len(results) and results[end].op == Op.LABEL:
+                if results[end].arg == results[idx].arg:
+                    del results[idx]
+                    break
+                end += 1
+        idx -= 1
+    return results
+
+
+PASSES = [fold_constants, eliminate_push_pop, invert_branches, remove_unreachable]
+
+
+def split_functions(instructions: Iterable[Instruction]) -> Iterator[list[Instruction]]:
+    """
+    :return: the commands before the first function, then every function
+    """
+    function: list[Instruction] = []
+    for instruction in instructions:
+        if instruction.op == Op.FUNCTION and function:
+            yield function
+            function = []
+        function.append(instruction)
+    if function:
+        yield function
+
+
+def optimize(instructions: Iterable[Instruction]) -> Iterator[Instruction]:
+    """
+    Run PASSES over one function at a time until none of them removes a command.
+    """
+    for function in split_functions(instructions):
+        size = len(function) + 1
+        while len(function) < size:
+            size = len(function)
+            for optimization in PASSES:
+                function = optimization(function)
+        yield from function
+
+
+def fuse_sequence(instructions: list[Instruction], idx: int) -> tuple[Instruction, int]:
+    """
+    :return: the superinstruction for the sequence starting at `idx` and the
+        number of instructions it replaces, or the instruction itself and 1
+    """
+    first = instructions[idx]
+    following = instructions[idx + 1 : idx + 4]
+    ops = [instruction.op for instruction in following]
+    if (
+        first.op == Op.PUSH
+        and ops[:3] == [Op.ADD, Op.POP, Op.PUSH]
+        and following[1].arg == Segment.POINTER
+        and following[1].index == 1
+        and following[2].arg == Segment.THAT
+        and following[2].index == 0
+    ):
+        return Instruction(Op.LOAD_INDEXED, first.arg, first.index, first.line), 4
+    if first.op in BRANCH_FUSIONS:
+        jumps = BRANCH_FUSIONS[first.op]
+        if ops[:1] == [Op.IF_GOTO]:
+            return Instruction(jumps[0], following[0].arg, line=first.line), 2
+        if ops[:1] == [Op.IF_NOT_GOTO]:
+            return Instruction(jumps[1], following[0].arg, line=first.line), 2
+        if ops[:2] == [Op.NOT, Op.IF_GOTO]:
+            return Instruction(jumps[1], following[1].arg, line=first.line), 3
+    if is_constant(first) and ops[:1] == [Op.ADD]:
+        return Instruction(Op.ADD_CONSTANT, index=first.index, line=first.line), 2
+    if is_constant(first) and ops[:1] == [Op.SUB]:
+        return Instruction(Op.SUB_CONSTANT, index=first.index, line=first.line), 2
+    return first, 1
+
+
+def fuse(instructions: Iterable[Instruction], counts: Counter) -> Iterator[Instruction]:
+    """
+    Replace the sequences the Jack compiler emits for array reads, conditions and
+    literal operands by superinstructions, counted by name in `counts`.
+    """
+    for function in split_functions(instructions):
+        idx = 0
+        while idx < len(function):
+            instruction, size = fuse_sequence(function, idx)
+            if size > 1:
+                counts[NAMES[instruction.op]] += 1
+            yield instruction
+            idx += size
+
+
+def writes_pointers(function: list[Instruction]) -> list[int]:
+    """
+    :return: the pointer segment indexes a function sets, i.e. whether it changes
+        THIS and THAT
+    """
+    indexes = {
+        instruction.index
+        for instruction in function
+        if instruction.op == Op.POP and instruction.arg == Segment.POINTER
+    }
+    if any(instruction.op == Op.LOAD_INDEXED for instruction in function):
+        indexes.add(1)
+    return sorted(indexes)
+
+
+def arguments_used(function: list[Instruction]) -> int:
+    return max(
+        (
+            instruction.index + 1
+            for instruction in function
+            if instruction.op in SEGMENT_OPERATIONS
+            and instruction.arg == Segment.ARGUMENT
+        ),
+        default=0,
+    )
+
+
+def inline_call(
+    body: list[Instruction], n_args: int, base: int, prefix: str
+) -> tuple[list[Instruction], int]:
+    """
+    Copy a function for a call with `n_args` arguments. Its arguments, local
+    variables and the THIS/THAT it changes are kept in the local variables of the
+    caller from `base`, its labels are prefixed and its returns jump to its end.
+    :return: the commands and the number of local variables they use
+    """
+    n_vars = body[0].index
+    pointers = writes_pointers(body)
+    code = [
+        Instruction(Op.POP, Segment.LOCAL, base + i) for i in reversed(range(n_args))
+    ]
+    for slot, index in enumerate(pointers, base + n_args + n_vars):
+        code += [
+            Instruction(Op.PUSH, Segment.POINTER, index),
+            Instruction(Op.POP, Segment.LOCAL, slot),
+        ]
+    for index in range(n_vars):
+        code += [
+            Instruction(Op.PUSH, Segment.CONSTANT, 0),
+            Instruction(Op.POP, Segment.LOCAL, base + n_args + index),
+        ]
+    end = f"{prefix}end"
+    for instruction in body[1:]:
+        if instruction.op in SEGMENT_OPERATIONS and instruction.arg == Segment.ARGUMENT:
+            instruction = Instruction(
+                instruction.op, Segment.LOCAL, base + instruction.index
+            )
+        elif instruction.op in SEGMENT_OPERATIONS and instruction.arg == Segment.LOCAL:
+            instruction = Instruction(
+                instruction.op, Segment.LOCAL, base + n_args + instruction.index
+            )
+        elif instruction.op in BRANCHES:
+            instruction = Instruction(instruction.op, prefix + instruction.arg)
+        elif instruction.op == Op.RETURN:
+            instruction = Instruction(Op.GOTO, end)
+        code.append(instruction)
+    if code[-1] == Instruction(Op.GOTO, end):
+        code.pop()
+    if Instruction(Op.GOTO, end) in code:
+        code.append(Instruction(Op.LABEL, end))
+    for slot, index in enumerate(pointers, base + n_args + n_vars):
+        code += [
+            Instruction(Op.PUSH, Segment.LOCAL, slot),
+            Instruction(Op.POP, Segment.POINTER, index),
+        ]
+    return code, n_args + n_vars + len(pointers)
+
+
+def inline(
+    instructions: Iterable[Instruction],
+    bodies: dict[str, list[Instruction]],
+    counts: Counter,
+) -> Iterator[Instruction]:
+    """
+    Replace the calls of `bodies`, functions that don't call any other and return
+    with only their value on the stack, by a copy of their commands. The local
+    variables of the caller are extended for the copies, which all share them.
+    """
+    for function in split_functions(instructions):
+        if function[0].op != Op.FUNCTION:
+            yield from function
+            continue
+        base = function[0].index
+        n_extra = 0
+        results = [function[0]]
+        for instruction in function[1:]:
+            body = bodies.get(instruction.arg) if instruction.op == Op.CALL else None
+            if body is None or arguments_used(body) > instruction.index:
+                results.append(instruction)
+                continue
+            prefix = f"{instruction.arg}$inline.{len(results)}."
+            code, n_vars = inline_call(body, instruction.index, base, prefix)
+            # the copy comes from the call, the lines of the body are in its file
+            results.extend(
+                Instruction(copy.op, copy.arg, copy.index, instruction.line)
+                for copy in code
+            )
+            n_extra = max(n_extra, n_vars)
+            counts[instruction.arg] += 1
+        if n_extra:
+            results[0] = Instruction(
+                Op.FUNCTION, function[0].arg, base + n_extra, function[0].line
+            )
+        yield from results
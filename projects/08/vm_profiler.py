@@ -0,0 +1,266 @@
+import argparse
+import bisect
+import glob
+import marshal
+import os
+import re
+import time
+from collections import Counter
+from typing import Optional
+
+from vm_interpreter import VMInterpreter, load_program
+from vm_ir import Instruction, Op, Segment
+from vm_translator import VMTranslator
+
+# commands after which the next one to run may not be the following command
+TRANSFERS = {Op.GOTO, Op.IF_GOTO, Op.CALL, Op.RETURN}
+FUNCTION_LINE = re.compile(r"^\s*function\s+(\S+)")
+
+
+def command_costs(
+    instructions: list[Instruction], direct_arithmetic: bool = False
+) -> list[int]:
+    """
+    :return: the number of Hack instructions vm_translator generates for each
+        command, which is its number of cycles apart from the branches of
+        eq/gt/lt, where only one of the two paths runs
+    """
+    translator = VMTranslator("Profile", direct_arithmetic=direct_arithmetic)
+    costs: dict[tuple, int] = {}
+    result = []
+    for instruction in instructions:
+        # labels and function names don't change the generated code
+        arg = instruction.arg if isinstance(instruction.arg, Segment) else None
+        key = (instruction.op, arg, instruction.index)
+        if key not in costs:
+            code = translator.translate([str(instruction)])
+            costs[key] = sum(not line.startswith(("(", "//")) for line in code)
+        result.append(costs[key])
+    return result
+
+
+def function_locations(vm_files: list[str]) -> dict[str, tuple[str, int]]:
+    """
+    :return: the file and line of every `function` command, by function name
+    """
+    locations = {}
+    for vm_file in vm_files:
+        with open(vm_file, "r") as input_file:
+            for number, line in enumerate(input_file, 1):
+                match = FUNCTION_LINE.match(line)
+                if match:
+                    locations[match.group(1)] = (vm_file, number)
+    return locations
+
+
+class Frame:
+    def __init__(self, name: str, caller: Optional["Frame"], steps: int, cycles: int):
+        self.name = name
+        self.caller = caller
+        self.key = f"{caller.key};{name}" if caller else name
+        # totals of the whole run when the function was entered
+        self.steps = steps
+        self.cycles = cycles
+        self.exclusive_steps = 0
+        self.exclusive_cycles = 0
+
+
+class Profile:
+    """
+    Calls, commands and estimated cycles of every function of a run, exclusive
+    of the functions it calls or inclusive of them, and by caller.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.cycles = 0
+        self.calls: Counter = Counter()
+        # calls while the function wasn't already running, as cProfile counts them
+        self.primitive_calls: Counter = Counter()
+        self.exclusive_steps: Counter = Counter()
+        self.exclusive_cycles: Counter = Counter()
+        self.inclusive_steps: Counter = Counter()
+        self.inclusive_cycles: Counter = Counter()
+        # calls, exclusive cycles and inclusive cycles by (caller, callee)
+        self.edges: dict[tuple[str, str], list[int]] = {}
+        # exclusive cycles by call stack, as `Sys.init;Main.main;...`
+        self.stacks: Counter = Counter()
+        self.__stack: list[Frame] = []
+        self.__active: Counter = Counter()
+
+    def enter(self, name: str):
+        caller = self.__stack[-1] if self.__stack else None
+        self.__stack.append(Frame(name, caller, self.steps, self.cycles))
+        self.calls[name] += 1
+        if not self.__active[name]:
+            self.primitive_calls[name] += 1
+        self.__active[name] += 1
+
+    def execute(self, steps: int, cycles: int):
+        self.steps += steps
+        self.cycles += cycles
+        frame = self.__stack[-1]
+        frame.exclusive_steps += steps
+        frame.exclusive_cycles += cycles
+        self.stacks[frame.key] += cycles
+
+    def leave(self):
+        frame = self.__stack.pop()
+        name = frame.name
+        self.__active[name] -= 1
+        self.exclusive_steps[name] += frame.exclusive_steps
+        self.exclusive_cycles[name] += frame.exclusive_cycles
+        cycles = self.cycles - frame.cycles
+        # a recursive call is already counted by the outermost one
+        recursive = self.__active[name] > 0
+        if not recursive:
+            self.inclusive_steps[name] += self.steps - frame.steps
+            self.inclusive_cycles[name] += cycles
+        if frame.caller:
+            edge = self.edges.setdefault((frame.caller.name, name), [0, 0, 0])
+            edge[0] += 1
+            edge[1] += frame.exclusive_cycles
+            edge[2] += 0 if recursive else cycles
+
+    def finish(self):
+        """
+        Account the functions still running when the run stopped.
+        """
+        while self.__stack:
+            self.leave()
+
+    def pstats(self, locations: dict[str, tuple[str, int]]) -> dict:
+        """
+        :return: the statistics as marshalled by cProfile, with cycles for
+            seconds, for pstats, snakeviz or gprof2dot
+        """
+
+        def key(name: str) -> tuple[str, int, str]:
+            return (*locations.get(name, ("~", 0)), name)
+
+        callers: dict[str, dict] = {name: {} for name in self.calls}
+        for (caller, callee), (calls, exclusive, inclusive) in self.edges.items():
+            callers[callee][key(caller)] = (calls, calls, exclusive, inclusive)
+        return {
+            key(name): (
+                self.primitive_calls[name],
+                self.calls[name],
+                self.exclusive_cycles[name],
+                self.inclusive_cycles[name],
+                callers[name],
+            )
+            for name in self.calls
+        }
+
+    def report(self, top: int) -> str:
+        lines = [
+            f"{'calls':>10}{'commands':>12}{'cycles':>13}{'%':>7}"
+            f"{'incl. commands':>16}{'incl. cycles':>14}  function"
+        ]
+        for name, cycles in self.exclusive_cycles.most_common(top):
+            lines.append(
+                f"{self.calls[name]:>10}{self.exclusive_steps[name]:>12}"
+                f"{cycles:>13}{100 * cycles / max(self.cycles, 1):>7.2f}"
+                f"{self.inclusive_steps[name]:>16}"
+                f"{self.inclusive_cycles[name]:>14}  {name}"
+            )
+        return "\n".join(lines)
+
+
+def profile(interpreter: VMInterpreter, max_steps: int, costs: list[int]) -> Profile:
+    """
+    Run the interpreter one straight-line sequence of commands at a time, each
+    ending with a jump, call or return, so that the commands in between are
+    known without tracing them one by one.
+    """
+    instructions = interpreter.instructions
+    size = len(instructions)
+    # cycles of the commands before each index, and commands up to the next
+    # transfer of control included
+    prefix = [0]
+    for cost in costs:
+        prefix.append(prefix[-1] + cost)
+    lengths = [1] * (size + 1)
+    for idx in range(size - 1, -1, -1):
+        if instructions[idx].op not in TRANSFERS:
+            lengths[idx] = lengths[idx + 1] + 1
+    starts = sorted((idx, name) for name, idx in interpreter.functions.items())
+    indexes = [idx for idx, _ in starts]
+
+    def function_at(pc: int) -> str:
+        return starts[bisect.bisect_right(indexes, pc) - 1][1]
+
+    result = Profile()
+    result.enter(function_at(interpreter.pc))
+    while interpreter.steps < max_steps and not interpreter.halted:
+        start = interpreter.pc
+        steps = interpreter.run(min(lengths[start], max_steps - interpreter.steps))
+        if steps == 0:
+            break
+        end = start + steps
+        result.execute(steps, prefix[min(end, size)] - prefix[start])
+        op = instructions[end - 1].op if end <= size else None
+        # a builtin returns to the next command instead of entering the function
+        if op == Op.CALL and interpreter.pc != end:
+            result.enter(function_at(interpreter.pc))
+        elif op == Op.RETURN:
+            result.leave()
+    result.finish()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VM Profiler")
+    parser.add_argument("vm", help="a .vm file or a directory of them")
+    parser.add_argument(
+        "--steps", type=int, default=100_000_000, help="maximum commands to run"
+    )
+    parser.add_argument(
+        "--stop",
+        action="append",
+        default=["Sys.halt"],
+        help="function to halt on entering, Sys.halt by default",
+    )
+    parser.add_argument(
+        "--direct-arithmetic",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="estimate cycles as translated with --direct-arithmetic",
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="number of functions to print"
+    )
+    parser.add_argument(
+        "--pstats", help="file to write the statistics to in the pstats format"
+    )
+    parser.add_argument(
+        "--collapsed",
+        help="file to write the cycles of every call stack to for flamegraph.pl",
+    )
+    args = parser.parse_args()
+
+    input_path: str = os.path.abspath(args.vm)
+    vm_files: list[str] = (
+        sorted(glob.glob(f"{input_path}/*.vm"))
+        if os.path.isdir(input_path)
+        else [input_path]
+    )
+    assert len(vm_files) > 0, f"No *.vm file is found from {input_path}"
+    interpreter = load_program(vm_files, args.stop)
+    costs = command_costs(interpreter.instructions, args.direct_arithmetic)
+    start = time.perf_counter()
+    result = profile(interpreter, args.steps, costs)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Profiled {result.steps} commands and about {result.cycles} cycles "
+        f"in {elapsed:.2f}s"
+    )
+    print(result.report(args.top))
+    if args.pstats:
+        with open(args.pstats, "wb") as output_file:
+            marshal.dump(result.pstats(function_locations(vm_files)), output_file)
+    if args.collapsed:
+        with open(args.collapsed, "w") as output_file:
+            for stack, cycles in sorted(result.stacks.items()):
+                if cycles:
+                    output_file.write(f"{stack} {cycles}\n")
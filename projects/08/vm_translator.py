@@ -1,13 +1,56 @@
 import argparse
 import glob
 import os
-from typing import Optional
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator, Optional, TextIO
 
-from iteration_utilities import deepflatten
+import vm_ir
+import vm_linker
+import vm_optimizer
+from vm_cache import TranslationCache
+from vm_ir import COMPARE_BRANCHES, NAMES, Instruction, Op
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+
+from source_map import SourceMap  # noqa: E402
+
+COMPARISONS = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
 
 
 class VMTranslator:
-    def __init__(self, filename: str):
+    def __init__(
+        self,
+        filename: str,
+        direct_arithmetic: bool = False,
+        shared_routines: bool = False,
+        functions: Optional[set[str]] = None,
+        optimize: bool = False,
+        fuse: bool = False,
+        cache_top: bool = False,
+        frames: Optional[dict[str, vm_linker.Frame]] = None,
+        inline: Optional[dict[str, tuple[str, list[Instruction]]]] = None,
+    ):
+        """
+        :param direct_arithmetic: compute arithmetic and comparisons in place on
+            the stack top instead of through R14 and R15
+        :param shared_routines: jump to the routines of `shared_routines()` for
+            call, return and comparisons instead of inlining them
+        :param functions: if given, the bodies of other functions are skipped
+        :param optimize: run the passes of vm_optimizer before generating code
+        :param fuse: generate code for the superinstructions of vm_optimizer.fuse
+        :param cache_top: keep the stack top in D between commands of a basic
+            block, which replaces direct_arithmetic
+        :param frames: the static frames of vm_linker.allocate_frames, their
+            functions are called without saving the frame of the caller
+        :param inline: the functions of vm_linker.leaf_functions, whose calls are
+            replaced by their commands
+        """
         self.__label_id = 0
         self.__segment_map = {
             "argument": "ARG",
@@ -16,76 +59,160 @@ class VMTranslator:
             "local": "LCL",
         }
         self.__filename = filename
+        # VM labels are scoped by the function they appear in
+        self.__function_name: Optional[str] = None
+        self.__direct_arithmetic = direct_arithmetic
+        self.__shared_routines = shared_routines
+        self.__functions = functions
+        self.__optimize = optimize
+        self.__fuse = fuse
+        self.__cache_top = cache_top
+        # with cache_top, whether the stack top is in D rather than at RAM[SP-1]
+        self.__top_in_d = False
+        self.__frames: dict[str, vm_linker.Frame] = frames or {}
+        # static frame of the function being translated
+        self.__frame: Optional[vm_linker.Frame] = None
+        self.__inline_bodies = vm_linker.inline_bodies(inline or {}, filename)
+        # number of calls inlined, by function
+        self.inlined: Counter = Counter()
+        # number of superinstructions generated, by name
+        self.fusions: Counter = Counter()
+        # set once `function Sys.init` has been translated
+        self.has_sys_init = False
+        # VM line of the command being translated, 0 if it was generated
+        self.line = 0
 
-    def translate(self, lines: list[str]) -> list[str]:
-        return self.__handle_vm_code(
-            self.__handle_spaces(self.__handle_comments(lines))
-        )
+    def translate(self, lines: Iterable[str]) -> Iterator[str]:
+        """
+        Translate lazily: every Hack instruction is yielded as soon as its VM
+        command is read, so the input may be a file object. With `optimize`, a
+        function is read completely before it is translated.
+        """
+        instructions: Iterable[Instruction] = vm_ir.parse(lines)
+        if self.__functions is not None:
+            instructions = self.__select_functions(instructions)
+        if self.__inline_bodies:
+            instructions = vm_optimizer.inline(
+                instructions, self.__inline_bodies, self.inlined
+            )
+        if self.__optimize:
+            instructions = vm_optimizer.optimize(instructions)
+        if self.__fuse:
+            instructions = vm_optimizer.fuse(instructions, self.fusions)
+        return self.__handle_vm_code(instructions)
 
-    def __handle_vm_code(self, lines: list[str]) -> list[str]:
-        results: list[str] = []
-        for line in lines:
-            results.append(f"// {line}")
-            tokens: list[str] = line.split()
-            command: str = tokens[0]
-            if command == "push":
-                segment: Optional[str] = tokens[1] if len(tokens) > 1 else None
-                index: Optional[int] = int(tokens[2]) if len(tokens) > 2 else None
-                results.extend(self.__translate_push(segment, index))
-            elif command == "pop":
-                segment: Optional[str] = tokens[1] if len(tokens) > 1 else None
-                index: Optional[int] = int(tokens[2]) if len(tokens) > 2 else None
-                results.extend(self.__translate_pop(segment, index))
-            elif command == "label":
-                results.extend(self.__translate_label(label=tokens[1]))
-            elif command == "goto":
-                results.extend(self.__translate_goto(label=tokens[1]))
-            elif command == "if-goto":
-                results.extend(self.__translate_if_goto(label=tokens[1]))
-            elif command == "function":
-                results.extend(
-                    self.__translate_function(
-                        function_name=tokens[1], n_vars=int(tokens[2])
-                    )
+    def __select_functions(
+        self, instructions: Iterable[Instruction]
+    ) -> Iterator[Instruction]:
+        skipping = False
+        for instruction in instructions:
+            if instruction.op == Op.FUNCTION:
+                skipping = instruction.arg not in self.__functions
+            if not skipping:
+                yield instruction
+
+    def __handle_vm_code(self, instructions: Iterable[Instruction]) -> Iterator[str]:
+        for instruction in instructions:
+            self.line = instruction.line
+            yield f"// {instruction}"
+            if self.__cache_top:
+                cached_code = self.__translate_cached(instruction)
+                if cached_code is not None:
+                    yield from cached_code
+                    continue
+                # labels, jumps, calls and returns expect the stack in memory
+                yield from self.__spill_top()
+            op: Op = instruction.op
+            if op == Op.PUSH:
+                yield from self.__translate_push(
+                    instruction.arg.name.lower(), instruction.index
+                )
+            elif op == Op.POP:
+                yield from self.__translate_pop(
+                    instruction.arg.name.lower(), instruction.index
+                )
+            elif op == Op.LABEL:
+                yield from self.__translate_label(label=self.__scope(instruction.arg))
+            elif op == Op.GOTO:
+                yield from self.__translate_goto(label=self.__scope(instruction.arg))
+            elif op == Op.IF_GOTO:
+                yield from self.__translate_if_goto(label=self.__scope(instruction.arg))
+            elif op == Op.IF_NOT_GOTO:
+                yield from self.__translate_if_not_goto(
+                    label=self.__scope(instruction.arg)
+                )
+            elif op in COMPARE_BRANCHES:
+                yield from self.__translate_compare_branch(
+                    label=self.__scope(instruction.arg), jump=COMPARE_BRANCHES[op]
                 )
-            elif command == "call":
-                results.extend(
-                    self.__translate_call(
-                        function_name=tokens[1], n_args=int(tokens[2])
-                    )
+            elif op == Op.ADD_CONSTANT or op == Op.SUB_CONSTANT:
+                yield from self.__translate_add_constant(
+                    instruction.index if op == Op.ADD_CONSTANT else -instruction.index
                 )
-            elif command == "return":
-                results.extend(self.__translate_return())
+            elif op == Op.LOAD_INDEXED:
+                yield from self.__translate_load_indexed(
+                    instruction.arg.name.lower(), instruction.index
+                )
+            elif op == Op.FUNCTION:
+                yield from self.__translate_function(
+                    function_name=instruction.arg, n_vars=instruction.index
+                )
+            elif op == Op.CALL and instruction.arg in self.__frames:
+                yield from self.__translate_static_call(function_name=instruction.arg)
+            elif op == Op.CALL and self.__shared_routines:
+                yield from self.__translate_shared_call(
+                    function_name=instruction.arg, n_args=instruction.index
+                )
+            elif op == Op.CALL:
+                yield from self.__translate_call(
+                    function_name=instruction.arg, n_args=instruction.index
+                )
+            elif op == Op.RETURN and self.__frame is not None:
+                yield from self.__translate_static_return()
+            elif op == Op.RETURN and self.__shared_routines:
+                yield from self.__translate_goto("VM$RETURN")
+            elif op == Op.RETURN:
+                yield from self.__translate_return()
+            elif NAMES[op] in COMPARISONS and self.__shared_routines:
+                yield from self.__translate_shared_compare(NAMES[op])
+            elif self.__direct_arithmetic:
+                yield from self.__translate_direct_arithmetic(NAMES[op])
             else:
-                results.extend(self.__translate_arithmetic(command))
-        return results
+                yield from self.__translate_arithmetic(NAMES[op])
+        if self.__cache_top:
+            yield from self.__spill_top()
 
-    def __translate_function(self, function_name: str, n_vars: int) -> list[str]:
-        return [
-            f"({function_name})",
-            self.__select_address("temp", 6),
-            "M=0",
-            [self.__translate_push("temp", 6) for _ in range(n_vars)],
-        ]
+    def __translate_function(self, function_name: str, n_vars: int) -> Iterator[str]:
+        if function_name == "Sys.init":
+            self.has_sys_init = True
+        self.__function_name = function_name
+        self.__frame = self.__frames.get(function_name)
+        yield f"({function_name})"
+        if self.__frame is not None:
+            yield from self.__enter_static_frame()
+            return
+        yield from self.__select_address("scratch", 0)
+        yield "M=0"
+        for _ in range(n_vars):
+            yield from self.__translate_push("scratch", 0)
 
-    def __translate_call(self, function_name: str, n_args: int) -> list[str]:
-        def push_value(value: str, apply_address: Optional[bool] = None) -> list[str]:
-            return [
-                f"@{value}",
-                "D=A" if apply_address else "D=M",
-                self.__select_address("temp", 6),
-                "M=D",
-                self.__translate_push("temp", 6),
-            ]
+    def __translate_call(self, function_name: str, n_args: int) -> Iterator[str]:
+        def push_value(
+            value: str, apply_address: Optional[bool] = None
+        ) -> Iterator[str]:
+            yield f"@{value}"
+            yield "D=A" if apply_address else "D=M"
+            yield from self.__select_address("scratch", 0)
+            yield "M=D"
+            yield from self.__translate_push("scratch", 0)
 
-        ret_addr_label: str = f"{function_name}$ret.{self.__label_id}"
-        self.__label_id += 1
-        return [
-            push_value(ret_addr_label, True),
-            push_value("LCL"),
-            push_value("ARG"),
-            push_value("THIS"),
-            push_value("THAT"),
+        ret_addr_label: str = self.__return_label(function_name)
+        yield from push_value(ret_addr_label, True)
+        yield from push_value("LCL")
+        yield from push_value("ARG")
+        yield from push_value("THIS")
+        yield from push_value("THAT")
+        yield from [
             # ARG=SP-5-nArgs
             f"@{5 + n_args}",
             "D=A",
@@ -98,11 +225,94 @@ class VMTranslator:
             "D=M",
             "@LCL",
             "M=D",
-            self.__translate_goto(function_name),
+        ]
+        yield from self.__translate_goto(function_name)
+        yield f"({ret_addr_label})"
+
+    def __enter_static_frame(self) -> Iterator[str]:
+        # the arguments are popped once here rather than at every call site
+        frame = self.__frame
+        for index in reversed(range(frame.n_args)):
+            yield from ["@SP", "AM=M-1", "D=M", f"@{frame.argument(index)}", "M=D"]
+        if frame.saves_this:
+            yield from ["@THIS", "D=M", f"@{frame.address + 1}", "M=D"]
+        if frame.saves_that:
+            yield from ["@THAT", "D=M", f"@{frame.address + 2}", "M=D"]
+        for index in range(frame.n_vars):
+            yield from [f"@{frame.local(index)}", "M=0"]
+
+    def __translate_static_call(self, function_name: str) -> list[str]:
+        # the callee pops its arguments into its frame and returns its value in D
+        frame = self.__frames[function_name]
+        code: list[str] = self.__spill_top()
+        ret_addr_label: str = self.__return_label(function_name)
+        code += [
+            f"@{ret_addr_label}",
+            "D=A",
+            f"@{frame.address}",
+            "M=D",
+            *self.__translate_goto(function_name),
+            f"({ret_addr_label})",
+        ]
+        if self.__cache_top:
+            self.__top_in_d = True
+            return code
+        return code + ["@SP", "AM=M+1", "A=A-1", "M=D"]
+
+    def __translate_static_return(self) -> list[str]:
+        frame = self.__frame
+        code: list[str] = []
+        if frame.saves_this or frame.saves_that:
+            code += self.__spill_top()
+        if frame.saves_this:
+            code += [f"@{frame.address + 1}", "D=M", "@THIS", "M=D"]
+        if frame.saves_that:
+            code += [f"@{frame.address + 2}", "D=M", "@THAT", "M=D"]
+        return code + self.__pop_d() + [f"@{frame.address}", "A=M", "0;JMP"]
+
+    def __pop_d(self) -> list[str]:
+        if not self.__cache_top:
+            return ["@SP", "AM=M-1", "D=M"]
+        code = self.__fill_top()
+        self.__top_in_d = False
+        return code
+
+    def __translate_shared_call(self, function_name: str, n_args: int) -> list[str]:
+        ret_addr_label: str = self.__return_label(function_name)
+        return [
+            f"@{ret_addr_label}",
+            "D=A",
+            "@R13",
+            "M=D",
+            f"@{function_name}",
+            "D=A",
+            "@R14",
+            "M=D",
+            f"@{n_args}",
+            "D=A",
+            *self.__translate_goto("VM$CALL"),
+            f"({ret_addr_label})",
+        ]
+
+    def __translate_shared_compare(self, command: str) -> list[str]:
+        ret_addr_label: str = f"{self.__filename}.compare_label_{self.__label_id}"
+        self.__label_id += 1
+        return [
+            f"@{ret_addr_label}",
+            "D=A",
+            "@R13",
+            "M=D",
+            *self.__translate_goto(f"VM${command.upper()}"),
             f"({ret_addr_label})",
         ]
 
-    def __translate_return(self) -> list[str]:
+    def __return_label(self, function_name: str) -> str:
+        # prefixed by the file like statics, since every file counts from 0
+        label = f"{self.__filename}.{function_name}$ret.{self.__label_id}"
+        self.__label_id += 1
+        return label
+
+    def __translate_return(self) -> Iterator[str]:
         def restore_value(base: str, offset: int, target: str) -> list[str]:
             return [
                 f"@{abs(offset)}",
@@ -114,7 +324,7 @@ class VMTranslator:
                 "M=D",
             ]
 
-        return [
+        yield from [
             # calc retAddr first to avoid being override if the function has no arguments
             "@5",
             "D=A",
@@ -124,10 +334,12 @@ class VMTranslator:
             "D=M",
             "@retAddr",
             "M=D",
-            # store the return value to ARG[0]
-            self.__translate_pop("argument", 0),
-            # set SP to ARG[1]
-            self.__select_address("argument", 1),
+        ]
+        # store the return value to ARG[0]
+        yield from self.__translate_pop("argument", 0)
+        # set SP to ARG[1]
+        yield from self.__select_address("argument", 1)
+        yield from [
             "D=A",
             "@SP",
             "M=D",
@@ -136,16 +348,23 @@ class VMTranslator:
             "D=M",
             "@endFrame",
             "M=D",
-            restore_value("endFrame", -4, "LCL"),
-            restore_value("endFrame", -3, "ARG"),
-            restore_value("endFrame", -2, "THIS"),
-            restore_value("endFrame", -1, "THAT"),
+        ]
+        yield from restore_value("endFrame", -4, "LCL")
+        yield from restore_value("endFrame", -3, "ARG")
+        yield from restore_value("endFrame", -2, "THIS")
+        yield from restore_value("endFrame", -1, "THAT")
+        yield from [
             # return to the caller address
             "@retAddr",
             "A=M",
             "0;JMP",
         ]
 
+    def __scope(self, label: str) -> str:
+        if self.__function_name is None:
+            return label
+        return f"{self.__function_name}${label}"
+
     def __translate_label(self, label: str) -> list[str]:
         return [
             f"({label})",
@@ -157,15 +376,68 @@ class VMTranslator:
             "0;JMP",
         ]
 
-    def __translate_if_goto(self, label: str) -> list[str]:
+    def __translate_if_goto(self, label: str) -> Iterator[str]:
+        yield from self.__translate_pop("scratch", 0)
+        yield from self.__select_address("scratch", 0)
+        yield "D=M"
+        yield f"@{label}"
+        yield "D;JNE"
+
+    def __translate_if_not_goto(self, label: str) -> list[str]:
+        return [
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            f"@{label}",
+            "D;JEQ",
+        ]
+
+    def __translate_compare_branch(self, label: str, jump: str) -> list[str]:
         return [
-            self.__translate_pop("temp", 6),
-            self.__select_address("temp", 6),
+            "@SP",
+            "AM=M-1",
             "D=M",
+            "@SP",
+            "AM=M-1",
+            "D=M-D",
             f"@{label}",
-            "D;JNE",
+            f"D;{jump}",
+        ]
+
+    def __translate_add_constant(self, value: int) -> list[str]:
+        if value == 1:
+            return ["@SP", "A=M-1", "M=M+1"]
+        if value == -1:
+            return ["@SP", "A=M-1", "M=M-1"]
+        return [
+            f"@{abs(value)}",
+            "D=A",
+            "@SP",
+            "A=M-1",
+            "M=D+M" if value >= 0 else "M=M-D",
         ]
 
+    def __translate_load_indexed(self, segment: str, index: int) -> list[str]:
+        # THAT is set like the `pop pointer 1` this replaces
+        return [
+            *self.__load_value(segment, index),
+            "@SP",
+            "A=M-1",
+            "D=D+M",
+            "@THAT",
+            "M=D",
+            "A=D",
+            "D=M",
+            "@SP",
+            "A=M-1",
+            "M=D",
+        ]
+
+    def __load_value(self, segment: str, index: int) -> list[str]:
+        if segment == "constant":
+            return [f"@{index}", "D=A"]
+        return [*self.__select_address(segment, index), "D=M"]
+
     def __select_address(self, segment: str, index: int) -> list[str]:
         if segment == "constant":
             # no address return for constant value
@@ -175,8 +447,16 @@ class VMTranslator:
         if segment == "temp":
             # MUST NOT USE D REGISTER HERE!!!
             return [f"@{index + 5}"]
+        if segment == "scratch":
+            # R14 and R15, which VM code can't address, hold the operands of
+            # the inlined sequences
+            return [f"@R{index + 14}"]
         if segment == "static":
             return [f"@{self.__filename}.{index}"]
+        if self.__frame is not None and segment == "local":
+            return [f"@{self.__frame.local(index)}"]
+        if self.__frame is not None and segment == "argument":
+            return [f"@{self.__frame.argument(index)}"]
         if segment in self.__segment_map.keys():
             return [
                 f"@{self.__segment_map.get(segment)}",
@@ -186,25 +466,22 @@ class VMTranslator:
             ]
         raise NotImplementedError(f"Unknown segment {segment}")
 
-    def __translate_push(self, segment: str, index: int) -> list[str]:
-        commands: list[str] = self.__select_address(segment, index)
+    def __translate_push(self, segment: str, index: int) -> Iterator[str]:
+        yield from self.__select_address(segment, index)
         if segment == "constant":
-            commands.extend([f"@{index}", "D=A"])
+            yield from [f"@{index}", "D=A"]
         else:
-            commands.extend(["D=M"])
-        commands.extend(
-            [
-                "@SP",
-                "M=M+1",
-                "A=M-1",
-                "M=D",
-            ]
-        )
-        return commands
+            yield "D=M"
+        yield from [
+            "@SP",
+            "M=M+1",
+            "A=M-1",
+            "M=D",
+        ]
 
-    def __translate_pop(self, segment: str, index: int) -> list[str]:
-        return [
-            self.__select_address(segment, index),
+    def __translate_pop(self, segment: str, index: int) -> Iterator[str]:
+        yield from self.__select_address(segment, index)
+        yield from [
             "D=A",
             "@R13",  # R13 stores the target address
             "M=D",
@@ -218,64 +495,60 @@ class VMTranslator:
             "M=D",
         ]
 
-    def __translate_arithmetic(self, command: str) -> list[str]:
-        def unary(operator: str) -> list[str]:
-            return [
-                self.__translate_pop("temp", 6),
-                self.__select_address("temp", 6),
-                f"M={operator}M",
-                self.__translate_push("temp", 6),
-            ]
+    def __translate_arithmetic(self, command: str) -> Iterator[str]:
+        def unary(operator: str) -> Iterator[str]:
+            yield from self.__translate_pop("scratch", 0)
+            yield from self.__select_address("scratch", 0)
+            yield f"M={operator}M"
+            yield from self.__translate_push("scratch", 0)
 
-        def binary(operator: str) -> list[str]:
-            return [
-                self.__translate_pop("temp", 7),
-                self.__translate_pop("temp", 6),
-                self.__select_address("temp", 7),
-                "D=A",
-                "@R13",
-                "M=D",
-                self.__select_address("temp", 6),
-                "D=M",
-                "@R13",
-                "A=M",
-                f"M=D{operator}M",
-                self.__translate_push("temp", 7),
-            ]
+        def binary(operator: str) -> Iterator[str]:
+            yield from self.__translate_pop("scratch", 1)
+            yield from self.__translate_pop("scratch", 0)
+            yield from self.__select_address("scratch", 1)
+            yield "D=A"
+            yield "@R13"
+            yield "M=D"
+            yield from self.__select_address("scratch", 0)
+            yield "D=M"
+            yield "@R13"
+            yield "A=M"
+            yield f"M=D{operator}M"
+            yield from self.__translate_push("scratch", 1)
 
-        def compare(jump: str):
+        def compare(jump: str) -> Iterator[str]:
             true_label, false_label, main_label = (
-                f"true_label_{self.__label_id}",
-                f"false_label_{self.__label_id}",
-                f"main_label_{self.__label_id}",
+                f"{self.__filename}.true_label_{self.__label_id}",
+                f"{self.__filename}.false_label_{self.__label_id}",
+                f"{self.__filename}.main_label_{self.__label_id}",
             )
             self.__label_id += 1
-            return [
-                self.__translate_pop("temp", 7),
-                self.__translate_pop("temp", 6),
-                self.__select_address("temp", 7),
-                "D=A",
-                "@R13",
-                "M=D",
-                self.__select_address("temp", 6),
+            yield from self.__translate_pop("scratch", 1)
+            yield from self.__translate_pop("scratch", 0)
+            yield from self.__select_address("scratch", 1)
+            yield "D=A"
+            yield "@R13"
+            yield "M=D"
+            yield from self.__select_address("scratch", 0)
+            yield from [
                 "D=M",
                 "@R13",
                 "A=M",
                 "D=D-M",
                 f"@{true_label}",
                 f"D;{jump}",
-                self.__translate_goto(false_label),
-                f"({true_label})",
-                "D=-1",
-                self.__translate_goto(main_label),
-                f"({false_label})",
-                "D=0",
-                self.__translate_goto(main_label),
-                f"({main_label})",
-                self.__select_address("temp", 7),
-                "M=D",
-                self.__translate_push("temp", 7),
             ]
+            yield from self.__translate_goto(false_label)
+            yield f"({true_label})"
+            yield "D=-1"
+            yield from self.__translate_goto(main_label)
+            yield f"({false_label})"
+            yield "D=0"
+            yield from self.__translate_goto(main_label)
+            yield f"({main_label})"
+            yield from self.__select_address("scratch", 1)
+            yield "M=D"
+            yield from self.__translate_push("scratch", 1)
 
         if command == "add":
             return binary("+")
@@ -298,11 +571,393 @@ class VMTranslator:
         else:
             raise NotImplementedError(f"Unknown command {command}")
 
-    def __handle_spaces(self, lines: list[str]) -> list[str]:
-        return [line.strip() for line in lines if line.strip()]
+    def __translate_direct_arithmetic(self, command: str) -> list[str]:
+        def unary(operator: str) -> list[str]:
+            return [
+                "@SP",
+                "A=M-1",
+                f"M={operator}M",
+            ]
+
+        def binary(computation: str) -> list[str]:
+            # D is the top of the stack, M the value under it
+            return [
+                "@SP",
+                "AM=M-1",
+                "D=M",
+                "A=A-1",
+                f"M={computation}",
+            ]
+
+        def compare(jump: str) -> list[str]:
+            end_label = f"{self.__filename}.end_label_{self.__label_id}"
+            self.__label_id += 1
+            return [
+                "@SP",
+                "AM=M-1",
+                "D=M",
+                "A=A-1",
+                "D=M-D",
+                "M=-1",
+                f"@{end_label}",
+                f"D;{jump}",
+                "@SP",
+                "A=M-1",
+                "M=0",
+                f"({end_label})",
+            ]
+
+        if command == "add":
+            return binary("D+M")
+        elif command == "sub":
+            return binary("M-D")
+        elif command == "neg":
+            return unary("-")
+        elif command == "eq":
+            return compare("JEQ")
+        elif command == "gt":
+            return compare("JGT")
+        elif command == "lt":
+            return compare("JLT")
+        elif command == "and":
+            return binary("D&M")
+        elif command == "or":
+            return binary("D|M")
+        elif command == "not":
+            return unary("!")
+        else:
+            raise NotImplementedError(f"Unknown command {command}")
+
+    def __translate_cached(self, instruction: Instruction) -> Optional[list[str]]:
+        """
+        Translate a command that works on the stack top kept in D.
+        :return: None for the commands that need the stack in memory
+        """
+        op: Op = instruction.op
+        if op == Op.PUSH:
+            code = self.__spill_top()
+            self.__top_in_d = True
+            segment = instruction.arg.name.lower()
+            address = self.__address_keeping_d(segment, instruction.index, 1)
+            if address is None:
+                return code + self.__load_value(segment, instruction.index)
+            return code + address + ["D=M"]
+        if op == Op.POP:
+            segment = instruction.arg.name.lower()
+            address = self.__address_keeping_d(segment, instruction.index)
+            if address is None:
+                return self.__spill_top() + list(
+                    self.__translate_pop(segment, instruction.index)
+                )
+            code = self.__fill_top()
+            self.__top_in_d = False
+            return code + address + ["M=D"]
+        if op == Op.IF_GOTO or op == Op.IF_NOT_GOTO or op in COMPARE_BRANCHES:
+            code = self.__fill_top()
+            self.__top_in_d = False
+            if op in COMPARE_BRANCHES:
+                code += ["@SP", "AM=M-1", "D=M-D"]
+            jump = COMPARE_BRANCHES.get(op, "JNE" if op == Op.IF_GOTO else "JEQ")
+            return code + [f"@{self.__scope(instruction.arg)}", f"D;{jump}"]
+        if op == Op.ADD_CONSTANT or op == Op.SUB_CONSTANT:
+            operator = "+" if op == Op.ADD_CONSTANT else "-"
+            if instruction.index == 1:
+                return self.__fill_top() + [f"D=D{operator}1"]
+            return self.__fill_top() + [f"@{instruction.index}", f"D=D{operator}A"]
+        if op == Op.LOAD_INDEXED:
+            segment = instruction.arg.name.lower()
+            address = self.__address_keeping_d(segment, instruction.index)
+            if segment == "constant":
+                code = self.__fill_top() + [f"@{instruction.index}", "D=D+A"]
+            elif address is not None:
+                code = self.__fill_top() + address + ["D=D+M"]
+            else:
+                code = self.__translate_cached(
+                    Instruction(Op.PUSH, instruction.arg, instruction.index)
+                ) + self.__translate_cached(Instruction(Op.ADD))
+            # THAT is set like the `pop pointer 1` this replaces
+            return code + ["@THAT", "M=D", "A=D", "D=M"]
+        if op == Op.CALL and instruction.arg in self.__frames:
+            return self.__translate_static_call(instruction.arg)
+        if op == Op.RETURN and self.__frame is not None:
+            return self.__translate_static_return()
+        if op in vm_ir.ARITHMETIC:
+            command = NAMES[op]
+            if command in COMPARISONS and self.__shared_routines:
+                return None
+            return self.__fill_top() + self.__compute_top(command)
+        return None
+
+    def __compute_top(self, command: str) -> list[str]:
+        """
+        Apply an arithmetic command to D, the top of the stack, and the value under
+        it, which is popped.
+        """
+        if command == "neg":
+            return ["D=-D"]
+        if command == "not":
+            return ["D=!D"]
+        if command in COMPARISONS:
+            true_label, end_label = (
+                f"{self.__filename}.true_label_{self.__label_id}",
+                f"{self.__filename}.end_label_{self.__label_id}",
+            )
+            self.__label_id += 1
+            return [
+                "@SP",
+                "AM=M-1",
+                "D=M-D",
+                f"@{true_label}",
+                f"D;{COMPARISONS[command]}",
+                "D=0",
+                f"@{end_label}",
+                "0;JMP",
+                f"({true_label})",
+                "D=-1",
+                f"({end_label})",
+            ]
+        computations = {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}
+        if command not in computations:
+            raise NotImplementedError(f"Unknown command {command}")
+        return ["@SP", "AM=M-1", computations[command]]
+
+    def __address_keeping_d(
+        self, segment: str, index: int, max_index: int = 7
+    ) -> Optional[list[str]]:
+        """
+        :return: instructions setting A to a segment address without using D, None
+            for constants and for local/argument/this/that above `max_index`,
+            where stepping A one by one costs more than going through memory
+        """
+        if segment == "constant":
+            return None
+        if self.__frame is not None and segment in ("local", "argument"):
+            return self.__select_address(segment, index)
+        if segment in self.__segment_map.keys():
+            if index > max_index:
+                return None
+            return [f"@{self.__segment_map[segment]}", "A=M", *["A=A+1"] * index]
+        return self.__select_address(segment, index)
+
+    def __spill_top(self) -> list[str]:
+        if not self.__top_in_d:
+            return []
+        self.__top_in_d = False
+        return ["@SP", "AM=M+1", "A=A-1", "M=D"]
+
+    def __fill_top(self) -> list[str]:
+        if self.__top_in_d:
+            return []
+        self.__top_in_d = True
+        return ["@SP", "AM=M-1", "D=M"]
+
+
+def write_lines(lines: Iterable[str], output_file: TextIO, batch_size: int = 4096):
+    """
+    Write lines separated by newlines, without a trailing one. Lines are joined in
+    batches of `batch_size` to keep the number of writes low.
+    """
+    lines = iter(lines)
+    separator = ""
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            break
+        output_file.write(separator + "\n".join(batch))
+        separator = "\n"
+
+
+def _translate_file(
+    vm_file: str, **options
+) -> tuple[str, bool, Counter, Counter, SourceMap]:
+    """
+    :return: the assembly of a whole file, whether it defines Sys.init, the
+        superinstructions it was fused into, the calls it inlined and the map of
+        its lines from 1 to the VM lines of its only file, the file being cached
+        by content wherever it is
+    """
+    translator = VMTranslator(
+        filename=os.path.splitext(os.path.basename(vm_file))[0], **options
+    )
+    source_map = SourceMap()
+    with open(vm_file, "r") as input_file:
+        code = "\n".join(
+            map_source(translator.translate(input_file), translator, "", source_map, 0)
+        )
+    return (
+        code,
+        translator.has_sys_init,
+        translator.fusions,
+        translator.inlined,
+        source_map,
+    )
+
+
+def _translate_files(
+    vm_files: list[str],
+    options: dict,
+    jobs: int,
+    cache: Optional[TranslationCache],
+) -> list[tuple[str, bool, Counter, Counter, SourceMap]]:
+    """
+    Translate whole files on a pool of `jobs` processes, except the ones found
+    in `cache`, which gets the others.
+    :return: the results of `_translate_file` in the order of vm_files
+    """
+    results = [cache.get(vm_file) if cache else None for vm_file in vm_files]
+    missing = [idx for idx, result in enumerate(results) if result is None]
+    translate = partial(_translate_file, **options)
+    if jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            translated = list(executor.map(translate, [vm_files[i] for i in missing]))
+    else:
+        translated = [translate(vm_files[idx]) for idx in missing]
+    for idx, result in zip(missing, translated):
+        results[idx] = result
+        if cache:
+            cache.put(vm_files[idx], result)
+    return results
+
+
+def map_source(
+    code: Iterable[str],
+    translator: VMTranslator,
+    vm_file: str,
+    source_map: SourceMap,
+    position: int,
+) -> Iterator[str]:
+    """
+    Add the VM line of every command of a file to `source_map` while its
+    translation is written after line `position` of the output.
+    :return: the last line of the file in the output
+    """
+    for line in code:
+        position += 1
+        if line.startswith("// "):
+            source_map.add(
+                position, vm_file if translator.line else None, translator.line
+            )
+        yield line
+    # the code that follows, e.g. the shared routines, has no VM source
+    source_map.add(position + 1, None)
+    return position
+
+
+def bootstrap(sp: Optional[int] = None) -> list[str]:
+    return (
+        [
+            f"@{sp}",
+            "D=A",
+            "@SP",
+            "M=D",
+        ]
+        if sp is not None
+        else []
+    ) + [
+        "@Sys.init",
+        "0;JMP",
+    ]
 
-    def __handle_comments(self, lines: list[str]) -> list[str]:
-        return [line.split("//")[0] for line in lines]
+
+def shared_routines() -> list[str]:
+    """
+    Routines jumped to by translators with `shared_routines`, behind a halt loop
+    so that programs falling off their end don't run into them.
+    """
+
+    def push_d() -> list[str]:
+        return ["@SP", "M=M+1", "A=M-1", "M=D"]
+
+    def restore_value(target: str) -> list[str]:
+        # walks LCL down through the saved frame
+        return ["@LCL", "AM=M-1", "D=M", f"@{target}", "M=D"]
+
+    routines = [
+        "(VM$END)",
+        "@VM$END",
+        "0;JMP",
+        # R13: return address, R14: callee, D: number of arguments
+        "(VM$CALL)",
+        "@R15",
+        "M=D",
+        "@R13",
+        "D=M",
+        *push_d(),
+    ]
+    for segment in ["LCL", "ARG", "THIS", "THAT"]:
+        routines.extend([f"@{segment}", "D=M", *push_d()])
+    routines.extend(
+        [
+            # ARG=SP-5-nArgs
+            "@R15",
+            "D=M",
+            "@5",
+            "D=D+A",
+            "@SP",
+            "D=M-D",
+            "@ARG",
+            "M=D",
+            # LCL=SP
+            "@SP",
+            "D=M",
+            "@LCL",
+            "M=D",
+            "@R14",
+            "A=M",
+            "0;JMP",
+            "(VM$RETURN)",
+            # save the return address before the return value may override it
+            "@5",
+            "D=A",
+            "@LCL",
+            "A=M-D",
+            "D=M",
+            "@R14",
+            "M=D",
+            # store the return value to ARG[0] and set SP to ARG[1]
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            "@ARG",
+            "A=M",
+            "M=D",
+            "@ARG",
+            "D=M+1",
+            "@SP",
+            "M=D",
+            *restore_value("THAT"),
+            *restore_value("THIS"),
+            *restore_value("ARG"),
+            *restore_value("LCL"),
+            "@R14",
+            "A=M",
+            "0;JMP",
+        ]
+    )
+    # R13: return address
+    for command, jump in COMPARISONS.items():
+        label = f"VM${command.upper()}"
+        routines.extend(
+            [
+                f"({label})",
+                "@SP",
+                "AM=M-1",
+                "D=M",
+                "A=A-1",
+                "D=M-D",
+                "M=-1",
+                f"@{label}$TRUE",
+                f"D;{jump}",
+                "@SP",
+                "A=M-1",
+                "M=0",
+                f"({label}$TRUE)",
+                "@R13",
+                "A=M",
+                "0;JMP",
+            ]
+        )
+    return routines
 
 
 if __name__ == "__main__":
@@ -319,48 +974,208 @@ if __name__ == "__main__":
     parser.add_argument(
         "--sp", type=int, default=None, help="set the value to SP when booting is True"
     )
+    parser.add_argument(
+        "--direct-arithmetic",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="compute arithmetic in place on the stack top",
+    )
+    parser.add_argument(
+        "--shared-routines",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="emit call, return and comparisons once and jump to them",
+    )
+    parser.add_argument(
+        "--optimize",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="fold constants and remove redundant VM commands before translating",
+    )
+    parser.add_argument(
+        "--prune-functions",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="drop the functions that are never called from Sys.init",
+    )
+    parser.add_argument(
+        "--fuse",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="translate common VM command sequences as superinstructions",
+    )
+    parser.add_argument(
+        "--cache-top",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="keep the stack top in the D register within basic blocks",
+    )
+    parser.add_argument(
+        "--static-frames",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="give fixed RAM to the locals and arguments of non-recursive functions",
+    )
+    parser.add_argument(
+        "--min-stack",
+        type=int,
+        default=vm_linker.MIN_STACK,
+        help="words of stack the static frames must leave",
+    )
+    parser.add_argument(
+        "--inline",
+        type=int,
+        default=0,
+        help="inline the functions of at most N VM commands that call no other",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="translate files on a pool of N processes",
+    )
+    parser.add_argument(
+        "--source-map",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="also write the VM file and line of every .asm line to a .map file",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="directory to keep the translation of every file in and reuse it from",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="megabytes the cache may take before the least recently used go",
+    )
+    parser.add_argument(
+        "--cache-entries",
+        type=int,
+        default=1024,
+        help="files the cache may keep before the least recently used go",
+    )
     args = parser.parse_args()
 
     input_path: str = os.path.abspath(args.vm)
     vm_files: list[str] = (
-        glob.glob(f"{input_path}/*.vm")
+        sorted(glob.glob(f"{input_path}/*.vm"))
         if os.path.isdir(input_path)
         else ([input_path] if input_path.endswith(".vm") else [])
     )
     assert len(vm_files) > 0, f"No *.vm file is found from {input_path}"
 
-    asm_code: list[str] = []
-    for vm_file in vm_files:
-        input_filename = os.path.splitext(os.path.basename(vm_file))[0]
-        translator: VMTranslator = VMTranslator(filename=input_filename)
-        with open(vm_file, "r") as input_file:
-            code: list[str] = input_file.read().splitlines()
-            asm_code.extend(translator.translate(code))
     output_path = (
         input_path + f"/{os.path.basename(input_path)}"
         if os.path.isdir(input_path)
         else input_path.rstrip(".vm")
     ) + ".asm"
 
-    asm_code = list(deepflatten(asm_code, ignore=str))
-    if args.booting and "(Sys.init)" in asm_code:
-        # inject the bootstrap code
-        asm_code = (
-            (
-                [
-                    f"@{args.sp}",
-                    "D=A",
-                    "@SP",
-                    "M=D",
-                ]
-                if args.sp is not None
-                else []
+    with open(output_path, "w", buffering=1 << 16) as output_file:
+        # the bootstrap goes first but depends on Sys.init being defined, so the
+        # translation is spooled to a temporary file until that is known
+        body_file: TextIO = (
+            tempfile.TemporaryFile("w+", buffering=1 << 16)
+            if args.booting
+            else output_file
+        )
+        options = {
+            "direct_arithmetic": args.direct_arithmetic,
+            "shared_routines": args.shared_routines,
+            "optimize": args.optimize,
+            "fuse": args.fuse,
+            "cache_top": args.cache_top,
+        }
+        if args.prune_functions:
+            calls, sizes = vm_linker.scan(vm_files)
+            if "Sys.init" in calls:
+                options["functions"] = vm_linker.reachable(calls)
+                print(vm_linker.report(calls, sizes, options["functions"]))
+            else:
+                print("Sys.init isn't defined, no function is dropped", file=sys.stderr)
+        if args.inline > 0:
+            options["inline"] = vm_linker.leaf_functions(vm_files, args.inline)
+        if args.static_frames:
+            calls, _ = vm_linker.scan(vm_files)
+            options["frames"] = vm_linker.allocate_frames(
+                vm_files, leaves=options.get("inline"), min_stack=args.min_stack
             )
-            + [
-                "@Sys.init",
-                "0;JMP",
-            ]
-            + asm_code
+            print(vm_linker.frame_report(calls, options["frames"]))
+        has_sys_init: list[bool] = []
+        fusions: Counter = Counter()
+        inlined: Counter = Counter()
+        source_map: Optional[SourceMap] = SourceMap() if args.source_map else None
+
+        cache: Optional[TranslationCache] = (
+            TranslationCache(
+                args.cache,
+                options,
+                args.cache_size << 20,
+                args.cache_entries,
+            )
+            if args.cache
+            else None
+        )
+
+        def translate_files() -> Iterator[str]:
+            position = 0
+            if args.jobs > 1 or cache:
+                # whole files come back in the order of vm_files
+                results = _translate_files(vm_files, options, args.jobs, cache)
+                for vm_file, result in zip(vm_files, results):
+                    code, sys_init, file_fusions, file_inlined, file_map = result
+                    has_sys_init.append(sys_init)
+                    fusions.update(file_fusions)
+                    inlined.update(file_inlined)
+                    if code:
+                        if source_map is not None:
+                            source_map.extend(file_map, position, [vm_file])
+                        position += code.count("\n") + 1
+                        yield code
+                return
+            for vm_file in vm_files:
+                input_filename = os.path.splitext(os.path.basename(vm_file))[0]
+                translator: VMTranslator = VMTranslator(
+                    filename=input_filename, **options
+                )
+                with open(vm_file, "r") as input_file:
+                    code = translator.translate(input_file)
+                    if source_map is None:
+                        yield from code
+                    else:
+                        position = yield from map_source(
+                            code, translator, vm_file, source_map, position
+                        )
+                has_sys_init.append(translator.has_sys_init)
+                fusions.update(translator.fusions)
+                inlined.update(translator.inlined)
+
+        write_lines(translate_files(), body_file)
+        if args.shared_routines:
+            write_lines(["", *shared_routines()], body_file)
+        if body_file is not output_file:
+            if any(has_sys_init):
+                # inject the bootstrap code
+                write_lines([*bootstrap(args.sp), ""], output_file)
+                if source_map is not None:
+                    source_map.shift(len(bootstrap(args.sp)))
+            body_file.seek(0)
+            shutil.copyfileobj(body_file, output_file)
+            body_file.close()
+    if source_map is not None:
+        source_map.write(output_path + ".map")
+    if cache:
+        evicted = cache.evict()
+        print(
+            f"Cache: {cache.hits} hits, {cache.misses} misses, {evicted} evicted",
+            file=sys.stderr,
+        )
+    for name, count in sorted(fusions.items()):
+        print(f"Fused {count} {name}")
+    if inlined:
+        print(
+            f"Inlined {sum(inlined.values())} calls to {len(inlined)} functions: "
+            + ", ".join(f"{name} ({count})" for name, count in sorted(inlined.items()))
         )
-    with open(output_path, "w") as output_file:
-        output_file.write("\n".join(asm_code))
@@ -9,8 +9,18 @@ from vm_writer import VMWriter
 
 
 class Parser:
-    def __init__(self, tokens: list[tuple[Token, str]], writer: VMWriter):
+    def __init__(
+        self,
+        tokens: list[tuple[Token, str]],
+        writer: VMWriter,
+        lines: Optional[list[int]] = None,
+    ):
+        """
+        :param lines: the line of every token, given to the writer as the source
+            of the commands written after reading it
+        """
         self.__tokens = tokens
+        self.__lines = lines
         self.__index = 0
         self.__vm_writer = writer
         self.__class_name = None
@@ -421,6 +431,8 @@ class Parser:
         if text is not None and text != actual_text:
             return None
         self.__index += 1
+        if self.__lines:
+            self.__vm_writer.source_line = self.__lines[self.__index - 1]
         return actual_token, actual_text
 
     def __compile_type(self) -> Optional[tuple[Token, str]]:
@@ -440,11 +452,24 @@ class Parser:
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="Jack Language Syntax Analysis")
     arg_parser.add_argument("directory", help="directory of Jack code")
+    arg_parser.add_argument(
+        "--source-map",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="also write the Jack line of every VM line to a .map file",
+    )
     args = arg_parser.parse_args()
     directory = os.path.abspath(args.directory)
     for jack_filepath in glob.glob(f"{directory}/*.jack"):
-        vm_writer: VMWriter = VMWriter(jack_filepath.replace(".jack", ".vm"))
+        vm_writer: VMWriter = VMWriter(
+            jack_filepath.replace(".jack", ".vm"),
+            jack_filepath if args.source_map else None,
+        )
         with open(jack_filepath, "r") as input_file:
             tokenizer: Tokenizer = Tokenizer(input_file.read())
-            parser: Parser = Parser(list(tokenizer), vm_writer)
+            tokens = list(tokenizer)
+            parser: Parser = Parser(
+                tokens, vm_writer, tokenizer.lines() if args.source_map else None
+            )
             parser.compile_class()
+        vm_writer.close()
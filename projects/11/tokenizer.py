@@ -39,6 +39,8 @@ class Tokenizer:
 
     def __iter__(self):
         self.__index = 0
+        # offset in the code of every token
+        self.offsets: list[int] = []
         return self
 
     def __next__(self) -> tuple[Token, str]:
@@ -49,6 +51,7 @@ class Tokenizer:
             pass
         if self.__index >= len(self.__code):
             raise StopIteration
+        self.offsets.append(self.__index)
         # STRING_CONSTANT
         if self.__code[self.__index] == '"':
             pos = self.__code.find('"', self.__index + 1)
@@ -83,6 +86,18 @@ class Tokenizer:
             else:
                 return Token.IDENTIFIER, val
 
+    def lines(self) -> list[int]:
+        """
+        :return: the line number of every token read so far
+        """
+        result: list[int] = []
+        line, position = 1, 0
+        for offset in self.offsets:
+            line += self.__code.count("\n", position, offset)
+            position = offset
+            result.append(line)
+        return result
+
     def __skip_spaces(self) -> bool:
         if self.__index < len(self.__code) and self.__code[self.__index].isspace():
             self.__index += 1
@@ -1,6 +1,24 @@
+import os
+import sys
+from typing import Optional
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+
+from source_map import SourceMap  # noqa: E402
+
+
 class VMWriter:
-    def __init__(self, output_filepath: str):
+    def __init__(self, output_filepath: str, source_filepath: Optional[str] = None):
+        """
+        :param source_filepath: if given, the line of this Jack file that every
+            command comes from, `source_line`, is written to a .map file
+        """
         self.__f = open(output_filepath, "w")
+        self.__output_filepath = output_filepath
+        self.__source_filepath = source_filepath
+        self.__source_map = SourceMap() if source_filepath else None
+        self.__lines = 0
+        self.source_line = 0
 
     def write_push(self, segment: str, index: int):
         self.__write("push", segment, index)
@@ -31,6 +49,13 @@ class VMWriter:
 
     def __write(self, *args):
         self.__f.write(" ".join([str(arg) for arg in args]) + "\n")
+        self.__lines += 1
+        if self.__source_map is not None:
+            self.__source_map.add(
+                self.__lines, self.__source_filepath, self.source_line
+            )
 
     def close(self):
         self.__f.close()
+        if self.__source_map is not None:
+            self.__source_map.write(self.__output_filepath + ".map")